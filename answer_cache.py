@@ -0,0 +1,127 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from config import config
+
+def normalize_query(query):
+    """Lowercase, collapse whitespace and drop trailing punctuation so trivial variants share a key."""
+    return re.sub(r"\s+", " ", query).strip().lower().rstrip("?!. ")
+
+def scope_key(model, chunk_ids, conversation=""):
+    """Answers are only reusable for the same model, retrieved chunk set and conversation memory (a fingerprint)."""
+    return hashlib.sha256(f"{model}\x00{','.join(sorted(chunk_ids))}\x00{conversation}".encode("utf-8")).hexdigest()
+
+class AnswerCache:
+    """LRU + TTL cache of LLM answers with an exact-match tier and an embedding-similarity tier."""
+
+    def __init__(self, ttl_s=3600, max_entries=10000, exact_match=True, similarity_threshold=None):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.exact_match = exact_match
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # key -> (scope, answer, query embedding, expires_at)
+        self._scopes = {}  # scope -> set of keys, so the similarity tier only scans comparable entries
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "similarity_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def _remove(self, key):
+        scope = self._entries.pop(key)[0]
+        keys = self._scopes[scope]
+        keys.discard(key)
+        if not keys:
+            del self._scopes[scope]
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] <= now:
+            self._remove(key)
+            self.stats["expirations"] += 1
+            return None
+        return entry
+
+    def get(self, query, model, chunk_ids, query_embedding=None, conversation=""):
+        """Return a cached answer or None.
+
+        Nothing is cached for an empty retrieval: without chunks the scope says nothing
+        about which chat the answer came from, so it could leak into another chat.
+        """
+        if not chunk_ids:
+            return None
+        scope = scope_key(model, chunk_ids, conversation)
+        key = f"{scope}:{normalize_query(query)}"
+        now = time.monotonic()
+        with self._lock:
+            if self.exact_match:
+                entry = self._live(key, now)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.stats["exact_hits"] += 1
+                    return entry[1]
+
+            if self.similarity_threshold is not None and query_embedding is not None:
+                best_key, best_score = None, self.similarity_threshold
+                query_vector = np.asarray(query_embedding, dtype=np.float32)
+                for candidate in list(self._scopes.get(scope, ())):
+                    entry = self._live(candidate, now)
+                    if entry is None or entry[2] is None:
+                        continue
+                    # Embeddings are normalized, so the dot product is the cosine similarity
+                    score = float(np.dot(entry[2], query_vector))
+                    if score >= best_score:
+                        best_key, best_score = candidate, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.stats["similarity_hits"] += 1
+                    return self._entries[best_key][1]
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, query, model, chunk_ids, answer, query_embedding=None, conversation=""):
+        if not chunk_ids:
+            return
+        scope = scope_key(model, chunk_ids, conversation)
+        key = f"{scope}:{normalize_query(query)}"
+        vector = np.asarray(query_embedding, dtype=np.float32) if query_embedding is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (scope, answer, vector, time.monotonic() + self.ttl_s)
+            self._scopes.setdefault(scope, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            hits = self.stats["exact_hits"] + self.stats["similarity_hits"]
+            lookups = hits + self.stats["misses"]
+            return {
+                **self.stats,
+                "hits": hits,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    """Return the process-wide answer cache, or None when it is disabled in config.yaml."""
+    global _cache
+    if not config.get("answer_cache_enabled", True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache(
+                ttl_s=config.get("answer_cache_ttl_s", 3600),
+                max_entries=config.get("answer_cache_max_entries", 10000),
+                exact_match=config.get("answer_cache_exact_match", True),
+                similarity_threshold=config.get("answer_cache_similarity_threshold"),
+            )
+        return _cache
@@ -1,34 +1,119 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
-import torch
 from llm_chains import chat, chat_pdf, handle_image
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
 from streamlit_mic_recorder import mic_recorder
-from utils import save_chat_history_json, get_timestamp, load_chat_history_json
-from audio_handler import transcribe_audio
-from pdf_handler import add_to_db
+from utils import get_timestamp, messages_from_dicts
+from session_store import get_session_store
+from audio_handler import get_transcription_engine, join_transcripts, submit_audio
+from pdf_handler import IngestProgress, add_pdfs_to_db, count_pages, document_hash
+from vector_store import get_client
+from cloudflare_client import get_sync_client
 from html_templates import get_bot_template, get_user_template, css
-import yaml
-import os
-from pydub import AudioSegment
-import io
+from config import config
 
-# Load configuration from yaml file
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+# Shared resources: created once per server process and reused by every rerun and browser session
+@st.cache_resource
+def transcription_engine():
+    return get_transcription_engine().start()
 
-# Load the chain (to process the chat)
-def load_chain(chat_history):
-    # Check if PDF chat mode is selected
-    if st.session_state.pdf_chat:
-        st.write("Loading PDF chat chain...")
-        return chat_pdf(chat_history)
+@st.cache_resource
+def audio_decoder():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="audio-decode")
+
+@st.cache_resource
+def vector_store_client():
+    return get_client()
+
+@st.cache_resource
+def workers_ai_client():
+    return get_sync_client()
+
+@st.cache_resource
+def session_store():
+    return get_session_store()
+
+@st.cache_data(ttl=30)
+def list_session_ids():
+    return [session["id"] for session in session_store().list_sessions()]
 
+# Uploaders keep their files attached across reruns, so per-upload work is keyed on content
+def upload_key(kind, data, *extra):
+    return (kind, hashlib.sha256(data).hexdigest(), *extra)
+
+class StreamlitIngestProgress(IngestProgress):
+    """Progress bar for PDF ingestion."""
+
+    def __init__(self, total_pages):
+        self.total_pages = max(1, total_pages)
+        self.pages = 0
+        self.chunks = 0
+        self.bar = st.progress(0.0, text="Reading PDFs...")
+
+    def add(self, pages=0, chunks=0):
+        self.pages += pages
+        self.chunks += chunks
+        self.bar.progress(min(1.0, self.pages / self.total_pages), text=f"{self.pages}/{self.total_pages} pages, {self.chunks} chunks embedded")
+
+# Decode audio on a pool thread and transcribe it on the engine's worker thread. The script
+# thread waits for both, redrawing the progress bar as segments are decoded and transcribed.
+def transcribe_with_progress(audio_bytes, label):
+    transcription_engine()
+    with st.status(label) as status:
+        futures = []
+        decoding = audio_decoder().submit(submit_audio, audio_bytes, futures.append)
+        bar = st.progress(0.0, text="Decoding audio...")
+        while not decoding.done():
+            queued = len(futures)
+            done = sum(future.done() for future in futures[:queued])
+            bar.progress(done / queued if queued else 0.0, text=f"{queued} segments decoded, {done} transcribed")
+            time.sleep(0.2)
+        futures = decoding.result()
+        for done, _ in enumerate(as_completed(futures), 1):
+            bar.progress(done / len(futures), text=f"{done}/{len(futures)} segments transcribed")
+        status.update(label="Transcription complete", state="complete")
+    return join_transcripts(future.result() for future in futures)
+
+# Load the chain (to process the chat) and render the response as it streams in
+def load_chain(chat_history, transcribe_text=None):
     # Assuming 'user_id', 'input', and 'transcribe' are available from the session or UI
     user_id = "some_user_id"  # Retrieve the user_id appropriately
     input_text = st.session_state.user_question if st.session_state.user_question != "" else ""  # Retrieve input text
-    transcribe_text = st.session_state.history[-1]['content'] if len(st.session_state.history) > 0 else ""  # If you want to pass transcribe text from chat history
 
-    return chat(chat_id=st.session_state.session_key, user_id=user_id, input=input_text, transcribe=transcribe_text)
+    # Check if PDF chat mode is selected
+    if st.session_state.pdf_chat:
+        st.write("Loading PDF chat chain...")
+        tokens = chat_pdf(chat_id=st.session_state.session_key, user_id=user_id, input=input_text, stream=True)
+    else:
+        if transcribe_text is None:
+            # History holds message objects, not dicts
+            transcribe_text = st.session_state.history[-1].content if len(st.session_state.history) > 0 else ""
+        tokens = chat(chat_id=st.session_state.session_key, user_id=user_id, input=input_text, transcribe=transcribe_text, stream=True)
+
+    # write_stream renders tokens incrementally and returns the full response
+    return st.write_stream(tokens)
+
+# Ingest uploaded PDFs into the vector store for the current session
+def add_documents_to_db(uploaded_files):
+    # The uploader keeps its files across reruns, so remember what this session already ingested
+    ingested = st.session_state.setdefault("ingested_pdfs", set())
+    docs = []
+    for uploaded_file in uploaded_files:
+        pdf_bytes = uploaded_file.getvalue()
+        key = (st.session_state.session_key, document_hash(pdf_bytes))
+        if key not in ingested:
+            docs.append((key, uploaded_file.name, pdf_bytes))
+    if not docs:
+        return []
+
+    vector_store_client()
+    progress = StreamlitIngestProgress(sum(count_pages(pdf_bytes) for _, _, pdf_bytes in docs))
+    reports = add_pdfs_to_db([(name, pdf_bytes) for _, name, pdf_bytes in docs], st.session_state.session_key, progress=progress)
+    progress.bar.progress(1.0, text=f"Ingested {len(docs)} PDF(s), {progress.chunks} chunks embedded")
+    ingested.update(key for key, _, _ in docs)
+    return reports
 
 # Clear the input field after sending the message
 def clear_input_field():
@@ -45,14 +130,44 @@ def set_send_input():
 def toggle_pdf_chat():
     st.session_state.pdf_chat = True
 
-# Save chat history
+# Save chat history: only messages added since the last save are appended to the store
 def save_chat_history():
-    if st.session_state.history != []:
-        if st.session_state.session_key == "new_session":
-            st.session_state.new_session_key = get_timestamp() + ".json"
-            save_chat_history_json(st.session_state.history, config["chat_history_path"] + st.session_state.new_session_key)
-        else:
-            save_chat_history_json(st.session_state.history, config["chat_history_path"] + st.session_state.session_key)
+    unsaved = st.session_state.history[st.session_state.persisted_count:]
+    if unsaved == []:
+        return
+    if st.session_state.session_key == "new_session":
+        if st.session_state.draft_session_id is None:
+            st.session_state.draft_session_id = get_timestamp()
+            st.session_state.new_session_key = st.session_state.draft_session_id
+            # The new session has to show up in the sidebar on the next rerun
+            list_session_ids.clear()
+        session_id = st.session_state.draft_session_id
+    else:
+        session_id = st.session_state.session_key
+    session_store().append_messages(session_id, [message.dict() for message in unsaved])
+    st.session_state.persisted_count = len(st.session_state.history)
+
+# Load the most recent page of a session, or start an empty one
+def load_session(session_key):
+    if session_key == "new_session":
+        messages = []
+        st.session_state.draft_session_id = None
+    else:
+        messages = session_store().load_messages(session_key, limit=config.get("session_page_size", 50))
+    st.session_state.history = messages_from_dicts(messages)
+    st.session_state.oldest_seq = messages[0]["seq"] if messages else None
+    st.session_state.persisted_count = len(messages)
+    st.session_state.loaded_session = session_key
+
+# Prepend the previous page of messages to the loaded history
+def load_earlier_messages():
+    messages = session_store().load_messages(
+        st.session_state.session_key, limit=config.get("session_page_size", 50), before_seq=st.session_state.oldest_seq
+    )
+    if messages:
+        st.session_state.history = messages_from_dicts(messages) + st.session_state.history
+        st.session_state.oldest_seq = messages[0]["seq"]
+        st.session_state.persisted_count += len(messages)
 
 # Main function to run the app
 def main():
@@ -61,7 +176,8 @@ def main():
     
     # Sidebar for selecting chat sessions
     st.sidebar.title("Chat Sessions")
-    chat_sessions = ["new_session"] + os.listdir(config["chat_history_path"])
+    chat_sessions = ["new_session"] + list_session_ids()
+    workers_ai_client()
 
     if "send_input" not in st.session_state:
         st.session_state.session_key = "new_session"
@@ -69,6 +185,9 @@ def main():
         st.session_state.user_question = ""
         st.session_state.new_session_key = None
         st.session_state.session_index_tracker = "new_session"
+        st.session_state.draft_session_id = None
+        st.session_state.loaded_session = None
+        st.session_state.processed_uploads = {}
     if st.session_state.session_key == "new_session" and st.session_state.new_session_key != None:
         st.session_state.session_index_tracker = st.session_state.new_session_key
         st.session_state.new_session_key = None
@@ -78,11 +197,15 @@ def main():
     st.sidebar.selectbox("Select a chat session", chat_sessions, key="session_key", index=index)
     st.sidebar.toggle("PDF Chat", key="pdf_chat", value=False)
 
-    # Load the chat history
-    if st.session_state.session_key != "new_session":
-        st.session_state.history = load_chat_history_json(config["chat_history_path"] + st.session_state.session_key)
-    else:
-        st.session_state.history = []
+    # Load the chat history only when the selected session changes
+    if st.session_state.loaded_session != st.session_state.session_key:
+        if st.session_state.session_key == st.session_state.draft_session_id:
+            # The draft we were writing to just got selected; its messages are already in memory
+            st.session_state.loaded_session = st.session_state.session_key
+        else:
+            load_session(st.session_state.session_key)
+    if st.session_state.oldest_seq:
+        st.sidebar.button("Load earlier messages", on_click=load_earlier_messages)
 
     chat_history = StreamlitChatMessageHistory(key="history")
 
@@ -105,46 +228,52 @@ def main():
         with st.spinner("Processing PDF..."):
             add_documents_to_db(uploaded_pdf)
 
-    # Handle audio upload
+    processed = st.session_state.processed_uploads
+
+    # Handle audio upload (once per file)
     if uploaded_audio:
-        transcribed_audio = transcribe_audio(uploaded_audio.getvalue())
-        st.write(f"Transcribed Audio: {transcribed_audio}")  # Show transcribed audio on the UI
-        llm_response = load_chain(chat_history)  # Get response from LLM
-        st.write("LLM Response: ", llm_response)  # Display LLM response on the UI
+        audio_bytes = uploaded_audio.getvalue()
+        key = upload_key("audio", audio_bytes)
+        if key not in processed:
+            transcribed_audio = processed[key] = transcribe_with_progress(audio_bytes, "Transcribing audio file...")
+            st.write(f"Transcribed Audio: {transcribed_audio}")  # Show transcribed audio on the UI
+            chat_history.add_user_message(f"Audio File: {transcribed_audio}")
+            st.write("LLM Response: ")
+            llm_response = load_chain(chat_history, transcribed_audio)  # Stream the LLM response onto the UI
+            chat_history.add_ai_message(llm_response)
 
     # Handle voice recording
     if voice_recording and "bytes" in voice_recording:
-        with st.spinner("Processing audio recording..."):
-            if voice_recording.get("format") == "webm":
-                webm_audio = AudioSegment.from_file(io.BytesIO(voice_recording["bytes"]), format="webm")
-                mp3_audio = io.BytesIO()
-                webm_audio.export(mp3_audio, format="mp3")
-                transcribed_audio = transcribe_audio(mp3_audio.getvalue())
-            else:
-                transcribed_audio = transcribe_audio(voice_recording["bytes"])
+        key = upload_key("recording", voice_recording["bytes"])
+        if key not in processed:
+            # ffmpeg decodes the recorder's webm straight to 16 kHz, no intermediate MP3
+            transcribed_audio = processed[key] = transcribe_with_progress(voice_recording["bytes"], "Processing audio recording...")
 
             chat_history.add_user_message(f"Audio Recording: {transcribed_audio}")
-            llm_response = load_chain(chat_history)
+            st.write("LLM Response: ")
+            llm_response = load_chain(chat_history, transcribed_audio)  # Stream the response onto the UI
             chat_history.add_ai_message(llm_response)
-            st.write(f"LLM Response: {llm_response}")  # Display response on the UI
 
-    # Handle image upload
+    # Handle image upload (once per image and question)
     if uploaded_image:
-        with st.spinner("Processing image..."):
-            user_message = "Describe this image in detail please."
-            if st.session_state.user_question != "":
-                user_message = st.session_state.user_question
-                st.session_state.user_question = ""
-            llm_answer = handle_image(uploaded_image.getvalue(), user_message)
+        user_message = "Describe this image in detail please."
+        if st.session_state.user_question != "":
+            user_message = st.session_state.user_question
+            st.session_state.user_question = ""
+        image_bytes = uploaded_image.getvalue()
+        key = upload_key("image", image_bytes, user_message)
+        if key not in processed:
+            with st.spinner("Processing image..."):
+                llm_answer = processed[key] = handle_image(image_bytes, user_message)
             chat_history.add_user_message(user_message)
             chat_history.add_ai_message(llm_answer)
             st.write(f"LLM Response for Image: {llm_answer}")  # Show image response
 
     # Handle text input and generate response
     if st.session_state.user_question != "":
-        llm_response = load_chain(chat_history)
+        st.write("LLM Response: ")
+        llm_response = load_chain(chat_history)  # Stream the response for text input
         st.session_state.user_question = ""
-        st.write(f"LLM Response: {llm_response}")  # Show response for text input
 
     st.session_state.send_input = False
 
@@ -1,24 +1,321 @@
-import torch
-from transformers import pipeline
-import librosa
-import io
+import queue
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+from metrics import span
+from config import config
+
+# Whisper's feature extractor works at 16 kHz, so decode straight to that rate
+SAMPLE_RATE = 16000
+# A seam repeats at least this many words before it is treated as overlap, so a single
+# word said twice ("... I" / "I think ...") survives the merge
+MIN_SEAM_WORDS = 2
+# Upper bound on speech rate, which caps how many words an overlap of a given length can hold
+MAX_WORDS_PER_SECOND = 4
+
+def iter_audio_chunks(audio, chunk_seconds=None):
+    """Decode audio (bytes or a file path) in any container ffmpeg supports to 16 kHz mono float32.
+
+    Yields arrays of at most chunk_seconds of audio as ffmpeg produces them, so memory
+    stays bounded by the chunk size rather than the clip length.
+    """
+    chunk_seconds = chunk_seconds or config.get("audio_chunk_seconds", 30)
+    from_path = isinstance(audio, str)
+    command = [
+        "ffmpeg", "-nostdin", "-loglevel", "error",
+        "-i", audio if from_path else "pipe:0",
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+        "pipe:1",
+    ]
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL if from_path else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    if not from_path:
+        # Feed stdin from a thread so a full stdout pipe can't deadlock us
+        def feed():
+            try:
+                process.stdin.write(audio)
+            except BrokenPipeError:
+                pass
+            finally:
+                process.stdin.close()
+        threading.Thread(target=feed, daemon=True).start()
+
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * 4
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        stderr_reader.join()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio: {b''.join(stderr).decode(errors='replace').strip()}")
 
 def convert_bytes_to_array(audio_bytes):
-    audio_bytes = io.BytesIO(audio_bytes)
-    audio, sample_rate = librosa.load(audio_bytes)
-    print(sample_rate)
-    return audio
+    chunks = list(iter_audio_chunks(audio_bytes))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+class TranscriptionEngine:
+    """Long-lived Whisper pipeline that serves queued requests in dynamic micro-batches."""
+
+    def __init__(self, model_name, max_batch_size=8, max_wait_ms=50, device=None, backend="torch", threads=0):
+        self.model_name = model_name
+        self.backend = backend
+        self.threads = threads
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.device = device
+        self._queue = queue.Queue()
+        self._pipe = None
+        self._worker = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def start(self):
+        # The model is loaded by the worker thread so callers never block on it here
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="whisper-engine", daemon=True)
+                self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker is not None and worker.is_alive():
+            self._queue.put(None)
+            worker.join(timeout)
+
+    def submit(self, audio_array):
+        """Queue an audio array for transcription and return a Future with the text."""
+        self.start()
+        future = Future()
+        self._queue.put((audio_array, future))
+        return future
+
+    def transcribe(self, audio_array):
+        return self.submit(audio_array).result()
+
+    @property
+    def loaded(self):
+        return self._pipe is not None
+
+    def load(self):
+        with self._load_lock:
+            if self._pipe is None:
+                # torch and transformers are only imported once audio is actually transcribed
+                from inference_backend import load_whisper
+                self._pipe = load_whisper(self.model_name, self.backend, self.device, self.threads)
+        return self._pipe
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        try:
+            self.load()
+        except Exception:
+            # Leave the error to surface on the first batch that needs the model
+            pass
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            # Skip requests whose caller already gave up
+            batch = [(audio, future) for audio, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                pipe = self.load()
+                inputs = [{"raw": audio, "sampling_rate": SAMPLE_RATE} for audio, _ in batch]
+                audio_seconds = sum(len(audio) for audio, _ in batch) / SAMPLE_RATE
+                with span("whisper_inference", batch_size=len(batch), audio_seconds=round(audio_seconds, 3)):
+                    outputs = pipe(inputs, batch_size=len(batch))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output["text"])
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_transcription_engine():
+    """Return the process-wide transcription engine, creating it on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TranscriptionEngine(
+                model_name=config.get("whisper_model", "openai/whisper-small"),
+                max_batch_size=config.get("transcription_max_batch_size", 8),
+                max_wait_ms=config.get("transcription_max_wait_ms", 50),
+                backend=config.get("whisper_backend", "torch"),
+                threads=config.get("whisper_threads", 0),
+            )
+        return _engine
+
+def transcription_engine_loaded():
+    """Whether the engine exists and has its model loaded; never creates it."""
+    return _engine is not None and _engine.loaded
+
+def stop_transcription_engine():
+    if _engine is not None:
+        _engine.stop()
+
+def iter_audio_windows(audio, chunk_seconds=None, overlap_seconds=None):
+    """Decode audio into windows of chunk_seconds that overlap by overlap_seconds.
+
+    The overlap gives Whisper context on both sides of every cut, like the
+    pipeline's own stride; join_transcripts drops the words it repeats.
+    """
+    chunk_seconds = chunk_seconds or config.get("audio_chunk_seconds", 30)
+    overlap_seconds = config.get("audio_chunk_overlap_seconds", 5) if overlap_seconds is None else overlap_seconds
+    windows = StreamingTranscriber(chunk_seconds, min(overlap_seconds, chunk_seconds / 2))
+    for chunk in iter_audio_chunks(audio, chunk_seconds):
+        for _, _, window in windows.feed(chunk):
+            yield window
+    last = windows.flush()
+    if last is not None:
+        yield last[2]
+
+def submit_audio(audio, on_submit=None):
+    """Decode audio window by window, queueing each window for transcription as soon as it is decoded.
+
+    on_submit, if given, is called with each window's Future as it is queued.
+    """
+    engine = get_transcription_engine()
+    futures = []
+    with span("audio_decode"):
+        for window in iter_audio_windows(audio):
+            futures.append(engine.submit(window))
+            if on_submit is not None:
+                on_submit(futures[-1])
+    return futures
+
+def join_transcripts(texts):
+    """Join the transcripts of consecutive overlapping windows, dropping the words repeated at each seam."""
+    merged = StreamingTranscriber(overlap_seconds=config.get("audio_chunk_overlap_seconds", 5))
+    for text in texts:
+        merged.merge(text.strip())
+    return merged.transcript
 
 def transcribe_audio(audio_bytes):
-    device = "cuda:0" if torch.cuda.is_available() else "cpu"
-
-    pipe = pipeline(
-        task="automatic-speech-recognition",
-        model="openai/whisper-small",
-        chunk_length_s=30,
-        device=device,
-    )   
-
-    audio_array = convert_bytes_to_array(audio_bytes)
-    prediction = pipe(audio_array, batch_size=1)["text"]
-    return prediction
+    return join_transcripts(future.result() for future in submit_audio(audio_bytes))
+
+def pcm_to_float32(data, sample_format="f32le"):
+    """Convert raw little-endian 16 kHz mono PCM frames (f32le or s16le) to float32 samples."""
+    if sample_format == "s16le":
+        samples = np.frombuffer(data[:len(data) - len(data) % 2], dtype="<i2")
+        return samples.astype(np.float32) / 32768.0
+    if sample_format == "f32le":
+        return np.frombuffer(data[:len(data) - len(data) % 4], dtype="<f4").astype(np.float32)
+    raise ValueError(f"Unsupported sample format: {sample_format}")
+
+def _normalize_word(word):
+    return "".join(ch for ch in word.lower() if ch.isalnum())
+
+class StreamingTranscriber:
+    """Sliding-window bookkeeping for transcribing audio while it is still being recorded.
+
+    Audio is cut into windows of window_seconds that overlap by overlap_seconds. Each
+    finished window is transcribed once as a final segment, and words repeated because
+    of the overlap are dropped when the segment is merged: at least MIN_SEAM_WORDS and
+    at most what overlap_seconds of speech can hold. In between, the open window
+    can be transcribed every partial_interval_seconds for a provisional partial result.
+    """
+
+    def __init__(self, window_seconds=None, overlap_seconds=None, partial_interval_seconds=None):
+        self.window = int((window_seconds or config.get("stream_window_seconds", 15)) * SAMPLE_RATE)
+        self.overlap = int((overlap_seconds if overlap_seconds is not None else config.get("stream_overlap_seconds", 2)) * SAMPLE_RATE)
+        self.partial_interval = int((partial_interval_seconds or config.get("stream_partial_interval_seconds", 1)) * SAMPLE_RATE)
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._start = 0  # absolute sample index of _buffer[0]
+        self._fresh = 0  # samples at the end of the buffer not yet covered by a final segment
+        self._since_partial = 0
+        self._words = []
+        self._max_seam_words = int(self.overlap / SAMPLE_RATE * MAX_WORDS_PER_SECOND)
+
+    def feed(self, samples):
+        """Append samples and return the (start_s, end_s, audio) windows that are now complete."""
+        self._buffer = np.concatenate([self._buffer, samples])
+        self._fresh += len(samples)
+        self._since_partial += len(samples)
+        ready = []
+        while len(self._buffer) >= self.window:
+            ready.append((self._start / SAMPLE_RATE, (self._start + self.window) / SAMPLE_RATE, self._buffer[:self.window]))
+            advance = self.window - self.overlap
+            self._buffer = self._buffer[advance:]
+            self._start += advance
+            self._fresh = max(0, len(self._buffer) - self.overlap)
+        return ready
+
+    def partial_due(self):
+        return self._fresh > 0 and self._since_partial >= self.partial_interval
+
+    def take_partial(self):
+        """Return the open window for a provisional transcription."""
+        self._since_partial = 0
+        return self._buffer.copy()
+
+    def flush(self):
+        """Return the last, shorter window if it holds any audio not yet finalized."""
+        if self._fresh < SAMPLE_RATE // 10:
+            return None
+        self._fresh = 0
+        return (self._start / SAMPLE_RATE, (self._start + len(self._buffer)) / SAMPLE_RATE, self._buffer.copy())
+
+    def _new_words(self, text):
+        # Drop the longest prefix of the new text that repeats the end of the transcript so far
+        words = text.split()
+        previous = [_normalize_word(word) for word in self._words[max(0, len(self._words) - self._max_seam_words):]]
+        current = [_normalize_word(word) for word in words]
+        for size in range(min(len(previous), len(current)), MIN_SEAM_WORDS - 1, -1):
+            if previous[-size:] == current[:size]:
+                return words[size:]
+        return words
+
+    def preview(self, text):
+        """Partial text for the open window, without the words already finalized."""
+        return " ".join(self._new_words(text))
+
+    def merge(self, text):
+        """Commit a final segment's text and return the part that is new."""
+        words = self._new_words(text)
+        self._words.extend(words)
+        return " ".join(words)
+
+    @property
+    def transcript(self):
+        return " ".join(self._words)
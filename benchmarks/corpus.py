@@ -0,0 +1,94 @@
+import io
+import math
+import os
+import random
+import struct
+import wave
+
+WORDS = (
+    "retrieval augmented generation vector store embedding chunk document page context "
+    "latency throughput model request response query answer index collection partition "
+    "token stream cache batch worker queue summary session transcript image audio"
+).split()
+
+def random_paragraph(rng, words=60):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_pdf(pages, rng, lines_per_page=40):
+    """Build a text-only PDF with the given number of pages, without any PDF library."""
+    objects = []
+    page_ids = []
+    font_id = 3
+    for _ in range(pages):
+        lines = ["BT", "/F1 10 Tf", "12 TL", "50 790 Td"]
+        for _ in range(lines_per_page):
+            lines.append(f"({_escape(random_paragraph(rng, 12))}) '")
+        lines.append("ET")
+        stream = "\n".join(lines).encode("latin-1")
+        content_id = 4 + len(objects)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(4 + len(objects))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (font_id, content_id)
+        )
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode("ascii")
+    all_objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % pages,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ] + objects
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(all_objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(all_objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(all_objects) + 1, xref))
+    return out.getvalue()
+
+def make_pdf_corpus(directory, documents=8, pages=20, seed=0):
+    """Write `documents` PDFs of `pages` pages each and return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for index in range(documents):
+        path = os.path.join(directory, f"doc_{index:03d}.pdf")
+        with open(path, "wb") as f:
+            f.write(make_pdf(pages, rng))
+        paths.append(path)
+    return paths
+
+def make_wav(seconds=5.0, sample_rate=16000, seed=0):
+    """A short 16-bit mono WAV of tones and noise; Whisper's cost depends on duration, not content."""
+    rng = random.Random(seed)
+    frames = bytearray()
+    for i in range(int(seconds * sample_rate)):
+        t = i / sample_rate
+        value = 0.3 * math.sin(2 * math.pi * (220 + 110 * math.sin(t)) * t) + 0.05 * (rng.random() - 0.5)
+        frames += struct.pack("<h", int(max(-1.0, min(1.0, value)) * 32767))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(bytes(frames))
+    return buffer.getvalue()
+
+def make_image(width=2048, height=1536, seed=0):
+    """A noisy RGB JPEG, large enough to exercise downscaling and re-encoding."""
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    image = Image.blend(image, Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3))), 0.5)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
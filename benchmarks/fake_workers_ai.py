@@ -0,0 +1,55 @@
+"""Local stand-in for the Workers AI ai/run endpoint.
+
+Behaviour is set through environment variables so the benchmark runner can launch it
+with uvicorn:
+
+    FAKE_AI_LATENCY_MS      delay before a non-streaming response (default 500)
+    FAKE_AI_TTFT_MS         delay before the first streamed token (default 200)
+    FAKE_AI_TOKEN_DELAY_MS  delay between streamed tokens (default 20)
+    FAKE_AI_TOKENS          tokens per response (default 64)
+"""
+import asyncio
+import json
+import os
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY_S = float(os.getenv("FAKE_AI_LATENCY_MS", "500")) / 1000
+TTFT_S = float(os.getenv("FAKE_AI_TTFT_MS", "200")) / 1000
+TOKEN_DELAY_S = float(os.getenv("FAKE_AI_TOKEN_DELAY_MS", "20")) / 1000
+TOKENS = int(os.getenv("FAKE_AI_TOKENS", "64"))
+
+app = FastAPI()
+stats = {"requests": 0, "streamed": 0, "prompt_chars": 0}
+
+def prompt_chars(body):
+    return sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+
+@app.post("/client/v4/accounts/{account_id}/ai/run/{model:path}")
+async def run(account_id: str, model: str, request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    stats["prompt_chars"] += prompt_chars(body)
+    usage = {"prompt_tokens": prompt_chars(body) // 4, "completion_tokens": TOKENS, "total_tokens": prompt_chars(body) // 4 + TOKENS}
+
+    if body.get("stream"):
+        stats["streamed"] += 1
+
+        async def events():
+            await asyncio.sleep(TTFT_S)
+            for i in range(TOKENS):
+                if i:
+                    await asyncio.sleep(TOKEN_DELAY_S)
+                yield f"data: {json.dumps({'response': f'tok{i} '})}\n\n"
+            yield f"data: {json.dumps({'response': '', 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    await asyncio.sleep(LATENCY_S)
+    response = " ".join(f"tok{i}" for i in range(TOKENS))
+    return JSONResponse(content={"result": {"response": response, "usage": usage}, "success": True, "errors": [], "messages": []})
+
+@app.get("/stats")
+async def get_stats():
+    return stats
@@ -0,0 +1,139 @@
+"""Accuracy and latency of each inference backend against the fp32 torch baseline.
+
+Run from the repo root (or a directory with a config.yaml):
+
+    python -m benchmarks.inference_benchmark --backends torch torch_int8 onnx onnx_int8 --audio clip1.wav clip2.wav
+
+Embeddings are compared by cosine similarity to the baseline vectors and by top-k
+neighbour agreement; transcripts by word error rate against the baseline transcript.
+Without --audio a generated clip is used, which only measures speed.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import numpy as np
+from audio_handler import SAMPLE_RATE, convert_bytes_to_array
+from benchmarks.corpus import make_wav, random_paragraph
+from config import config
+from inference_backend import BACKENDS, load_sentence_transformer, load_whisper
+
+def word_error_rate(reference, hypothesis):
+    reference, hypothesis = reference.lower().split(), hypothesis.lower().split()
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word)))
+        previous = current
+    return previous[-1] / len(reference)
+
+def top_k(vectors, queries, k):
+    scores = vectors[:queries] @ vectors.T
+    np.fill_diagonal(scores[:, :queries], -np.inf)
+    return [set(row) for row in np.argsort(-scores, axis=1)[:, :k]]
+
+def bench_embeddings(backend, texts, args):
+    started = time.perf_counter()
+    model = load_sentence_transformer(config["embeddings_path"], backend, threads=args.threads)
+    load_seconds = time.perf_counter() - started
+    encode = lambda: model.encode(texts, batch_size=config.get("embedding_batch_size", 64), normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False)
+    encode()
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        vectors = encode()
+        timings.append(time.perf_counter() - started)
+    seconds = min(timings)
+    return np.asarray(vectors, dtype=np.float32), {
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "texts_per_second": len(texts) / seconds,
+    }
+
+def bench_whisper(backend, clips, args):
+    started = time.perf_counter()
+    pipe = load_whisper(config.get("whisper_model", "openai/whisper-small"), backend, threads=args.threads)
+    load_seconds = time.perf_counter() - started
+    inputs = lambda: [{"raw": clip, "sampling_rate": SAMPLE_RATE} for clip in clips]
+    pipe(inputs()[:1])
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        outputs = pipe(inputs(), batch_size=len(clips))
+        timings.append(time.perf_counter() - started)
+    seconds = min(timings)
+    audio_seconds = sum(len(clip) for clip in clips) / SAMPLE_RATE
+    return [output["text"] for output in outputs], {
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "real_time_factor": seconds / audio_seconds,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inference backends against the fp32 torch baseline.")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--models", nargs="+", choices=["embeddings", "whisper"], default=["embeddings", "whisper"])
+    parser.add_argument("--texts", type=int, default=512, help="generated texts to embed")
+    parser.add_argument("--queries", type=int, default=32, help="texts used as queries for top-k agreement")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--audio", nargs="*", default=[], help="audio files to transcribe (any format ffmpeg reads)")
+    parser.add_argument("--audio-seconds", type=float, default=10.0, help="length of the generated clip without --audio")
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra-op threads (0 = all cores)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per backend; the fastest is reported")
+    parser.add_argument("--output", default="-", help="JSON results file, or - for stdout")
+    args = parser.parse_args()
+
+    backends = ["torch"] + [backend for backend in args.backends if backend != "torch"]
+    results = {"settings": vars(args)}
+
+    if "embeddings" in args.models:
+        rng = random.Random(0)
+        texts = [random_paragraph(rng, rng.randint(8, 120)) for _ in range(args.texts)]
+        results["embeddings"] = {}
+        for backend in backends:
+            vectors, stats = bench_embeddings(backend, texts, args)
+            if backend == "torch":
+                baseline, baseline_neighbours = vectors, top_k(vectors, args.queries, args.top_k)
+            else:
+                cosines = np.sum(vectors * baseline, axis=1)
+                neighbours = top_k(vectors, args.queries, args.top_k)
+                stats.update(
+                    mean_cosine=float(cosines.mean()),
+                    min_cosine=float(cosines.min()),
+                    top_k_agreement=float(np.mean([len(a & b) / args.top_k for a, b in zip(neighbours, baseline_neighbours)])),
+                    speedup=results["embeddings"]["torch"]["seconds"] / stats["seconds"],
+                )
+            results["embeddings"][backend] = stats
+            print(f"embeddings {backend}: {json.dumps(stats)}", file=sys.stderr)
+
+    if "whisper" in args.models:
+        if args.audio:
+            clips = [convert_bytes_to_array(open(path, "rb").read()) for path in args.audio]
+        else:
+            clips = [convert_bytes_to_array(make_wav(args.audio_seconds))]
+        results["whisper"] = {}
+        for backend in backends:
+            transcripts, stats = bench_whisper(backend, clips, args)
+            if backend == "torch":
+                baseline_transcripts = transcripts
+            else:
+                stats.update(
+                    word_error_rate=float(np.mean([word_error_rate(ref, hyp) for ref, hyp in zip(baseline_transcripts, transcripts)])),
+                    speedup=results["whisper"]["torch"]["seconds"] / stats["seconds"],
+                )
+            results["whisper"][backend] = stats
+            print(f"whisper {backend}: {json.dumps(stats)}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
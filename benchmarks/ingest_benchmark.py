@@ -0,0 +1,39 @@
+"""Ingestion throughput benchmark; run from a benchmark working directory by run_benchmarks.py."""
+import argparse
+import json
+import time
+from pdf_handler import add_to_db, add_pdfs_to_db
+
+def summarize(reports, seconds):
+    pages = sum(report["pages"] for report in reports)
+    return {
+        "files": len(reports),
+        "pages": pages,
+        "chunks": sum(report["chunks"] for report in reports),
+        "seconds": seconds,
+        "pages_per_second": pages / seconds if seconds else 0.0,
+        "per_file": reports,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serial", nargs="*", default=[], help="PDFs ingested one by one with add_to_db")
+    parser.add_argument("--parallel", nargs="*", default=[], help="PDFs ingested together with add_pdfs_to_db")
+    parser.add_argument("--serial-chat-id", type=int, default=1)
+    parser.add_argument("--parallel-chat-id", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    results = {}
+    if args.serial:
+        started = time.perf_counter()
+        reports = [add_to_db(path, args.serial_chat_id) for path in args.serial]
+        results["add_to_db"] = summarize(reports, time.perf_counter() - started)
+    if args.parallel:
+        started = time.perf_counter()
+        reports = add_pdfs_to_db(args.parallel, args.parallel_chat_id, max_workers=args.workers)
+        results["add_pdfs_to_db"] = summarize(reports, time.perf_counter() - started)
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
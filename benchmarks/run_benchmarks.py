@@ -0,0 +1,269 @@
+"""Offline end-to-end benchmarks.
+
+Starts fast_api.app against a local fake Workers AI server (benchmarks/fake_workers_ai.py)
+and an embedded Chroma store in a scratch directory, measures ingestion on a generated PDF
+corpus, then drives the HTTP endpoints at the requested concurrency. Results are written
+as JSON for run-to-run comparison:
+
+    python -m benchmarks.run_benchmarks --concurrency 8 --requests 200 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import httpx
+import yaml
+from benchmarks.corpus import make_pdf_corpus, make_wav, make_image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ["chat", "chat_stream", "chat_pdf", "handle_image", "transcribe_audio"]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Server settings that shape the measured numbers; they are reported with the results
+CONDITIONS = ("memory_enabled", "answer_cache_enabled", "upstream_rate_per_s")
+
+def write_config(workdir, answer_cache):
+    """Copy config.yaml into the scratch directory, pointing every store at local files.
+
+    Returns the CONDITIONS settings the server runs with.
+    """
+    with open(os.path.join(REPO_ROOT, "config.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    config.update({
+        "chat_history_path": os.path.join(workdir, "chat_sessions") + os.sep,
+        "session_store_path": os.path.join(workdir, "chat_sessions", "sessions.sqlite3"),
+        "vector_store_mode": "persistent",
+        "vector_store_path": os.path.join(workdir, "chroma_db"),
+        "embedding_cache_path": os.path.join(workdir, "embedding_cache.sqlite3"),
+        "ingest_manifest_path": os.path.join(workdir, "ingest_manifests") + os.sep,
+        "memory_store_path": os.path.join(workdir, "chat_sessions", "memory.sqlite3"),
+        "answer_cache_enabled": answer_cache,
+        # Every request reuses one chat id, so memory would grow the prompt (and add summarization
+        # calls) over the run and make latency and prompt sizes drift between iterations and runs
+        "memory_enabled": False,
+        # The fake upstream has no account limit, so only concurrency is adaptive here
+        "upstream_rate_per_s": 0,
+        "upstream_model_limits": {},
+    })
+    os.makedirs(config["chat_history_path"], exist_ok=True)
+    with open(os.path.join(workdir, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+    return {key: config.get(key) for key in CONDITIONS}
+
+def subprocess_env(extra=None):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    env.update(extra or {})
+    return env
+
+def start_uvicorn(app, port, cwd, env):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd,
+        env=env,
+    )
+
+async def wait_ready(url, timeout=300):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"{url} did not come up within {timeout}s")
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+def summarize(latencies, errors, elapsed, first_byte=None):
+    values = sorted(latency * 1000 for latency in latencies)
+    summary = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": sum(values) / len(values) if values else None,
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else None,
+    }
+    if first_byte is not None:
+        ttft = sorted(value * 1000 for value in first_byte)
+        summary.update({"ttft_p50_ms": percentile(ttft, 50), "ttft_p95_ms": percentile(ttft, 95), "ttft_p99_ms": percentile(ttft, 99)})
+    return summary
+
+async def run_load(send, total, concurrency):
+    """Issue `total` requests with at most `concurrency` in flight. send(i) returns a time to first token or None."""
+    latencies, first_byte = [], []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                ttft = await send(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            if ttft is not None:
+                first_byte.append(ttft)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started, first_byte or None
+
+def make_senders(client, pdf_chat_id, audio_bytes, image_bytes):
+    async def chat(i):
+        response = await client.post("/chat", json={"chat_id": 1, "user_id": 1, "input": f"Benchmark question {i}"})
+        response.raise_for_status()
+
+    async def chat_stream(i):
+        started = time.perf_counter()
+        ttft = None
+        async with client.stream("POST", "/chat", json={"chat_id": 1, "user_id": 1, "input": f"Benchmark question {i}", "stream": True}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if ttft is None and line.startswith("event: token"):
+                    ttft = time.perf_counter() - started
+                if line.startswith("event: error"):
+                    raise RuntimeError("stream error")
+        return ttft
+
+    async def chat_pdf(i):
+        response = await client.post("/chat_pdf", json={"chat_id": pdf_chat_id, "user_id": 1, "input": f"What does the document say about topic {i}?"})
+        response.raise_for_status()
+
+    async def handle_image(i):
+        response = await client.post(
+            "/handle_image",
+            params={"user_message": "Describe this image"},
+            files={"image_path": ("bench.jpg", image_bytes, "image/jpeg")},
+        )
+        response.raise_for_status()
+        if "error" in response.json():
+            raise RuntimeError(response.json()["error"])
+
+    async def transcribe_audio(i):
+        response = await client.post("/transcribe_audio", files={"audio_file": ("bench.wav", audio_bytes, "audio/wav")})
+        response.raise_for_status()
+
+    return {
+        "chat": chat,
+        "chat_stream": chat_stream,
+        "chat_pdf": chat_pdf,
+        "handle_image": handle_image,
+        "transcribe_audio": transcribe_audio,
+    }
+
+def run_ingestion(workdir, args):
+    serial = make_pdf_corpus(os.path.join(workdir, "corpus", "serial"), args.documents, args.pages, seed=1)
+    parallel = make_pdf_corpus(os.path.join(workdir, "corpus", "parallel"), args.documents, args.pages, seed=2)
+    command = [sys.executable, "-m", "benchmarks.ingest_benchmark", "--serial", *serial, "--parallel", *parallel]
+    if args.ingest_workers:
+        command += ["--workers", str(args.ingest_workers)]
+    output = subprocess.run(command, cwd=workdir, env=subprocess_env(), check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+async def run_endpoints(workdir, args):
+    fake_port, api_port = free_port(), free_port()
+    fake = start_uvicorn(
+        "benchmarks.fake_workers_ai:app", fake_port, workdir,
+        subprocess_env({
+            "FAKE_AI_LATENCY_MS": str(args.latency_ms),
+            "FAKE_AI_TTFT_MS": str(args.ttft_ms),
+            "FAKE_AI_TOKEN_DELAY_MS": str(args.token_delay_ms),
+            "FAKE_AI_TOKENS": str(args.tokens),
+        }),
+    )
+    api = start_uvicorn(
+        "fast_api:app", api_port, workdir,
+        subprocess_env({
+            "CLOUDFLARE_API_BASE": f"http://127.0.0.1:{fake_port}/client/v4",
+            "CLOUDFLARE_ACCOUNT_ID": "benchmark",
+            "CLOUDFLARE_AUTH_TOKEN": "benchmark",
+        }),
+    )
+    try:
+        await wait_ready(f"http://127.0.0.1:{fake_port}/stats")
+        await wait_ready(f"http://127.0.0.1:{api_port}/cache_stats")
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        results = {}
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}", timeout=600, limits=limits) as client:
+            senders = make_senders(client, 2, make_wav(args.audio_seconds), make_image())
+            for name in args.endpoints:
+                # A short warm-up keeps model loading out of the measured window
+                await run_load(senders[name], min(args.concurrency, 2), 1)
+                latencies, errors, elapsed, first_byte = await run_load(senders[name], args.requests, args.concurrency)
+                results[name] = summarize(latencies, errors, elapsed, first_byte)
+                print(f"{name}: {json.dumps(results[name])}", file=sys.stderr)
+        async with httpx.AsyncClient() as client:
+            upstream = (await client.get(f"http://127.0.0.1:{fake_port}/stats")).json()
+        return results, upstream
+    finally:
+        for process in (api, fake):
+            process.terminate()
+            process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmarks for the RAG service.")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--latency-ms", type=float, default=500, help="fake upstream latency for non-streaming calls")
+    parser.add_argument("--ttft-ms", type=float, default=200, help="fake upstream time to first token")
+    parser.add_argument("--token-delay-ms", type=float, default=20, help="fake upstream delay between tokens")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per fake completion")
+    parser.add_argument("--documents", type=int, default=8, help="PDFs per ingestion corpus")
+    parser.add_argument("--pages", type=int, default=20, help="pages per generated PDF")
+    parser.add_argument("--ingest-workers", type=int, default=None)
+    parser.add_argument("--audio-seconds", type=float, default=5.0)
+    parser.add_argument("--answer-cache", action="store_true", help="leave the /chat_pdf answer cache enabled")
+    parser.add_argument("--skip-ingestion", action="store_true")
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--output", default="-", help="JSON results file, or - for stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    try:
+        conditions = write_config(workdir, args.answer_cache)
+        results = {"started_at": datetime.now().isoformat(timespec="seconds"), "settings": vars(args), "server_config": conditions}
+        if not args.skip_ingestion:
+            results["ingestion"] = run_ingestion(workdir, args)
+        results["endpoints"], results["upstream"] = asyncio.run(run_endpoints(workdir, args))
+    finally:
+        if args.keep_workdir:
+            print(f"Benchmark files kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import asyncio
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
+from dotenv import load_dotenv
+from metrics import observe, record_size, span
+from upstream_scheduler import get_upstream_scheduler
+from config import config
+
+load_dotenv()
+
+ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID")
+AUTH_TOKEN = os.getenv("CLOUDFLARE_AUTH_TOKEN")
+API_BASE = os.getenv("CLOUDFLARE_API_BASE", "https://api.cloudflare.com/client/v4")
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def http2_available():
+    """HTTP/2 needs the optional h2 package (installed with httpx[http2])."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+class WorkersAIError(Exception):
+    """A Workers AI call that failed: a non-retryable response, or retries ran out."""
+
+    def __init__(self, message, status=None, retry_after=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+def retry_after_seconds(response):
+    """The Retry-After header as seconds (it may be a delay or an HTTP date), or None."""
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def classify(response):
+    """Scheduler outcome for an upstream response."""
+    if response.status_code == 429:
+        return "throttled"
+    if response.status_code >= 500:
+        return "server_errors"
+    if response.status_code >= 400:
+        return "client_errors"
+    return "ok"
+
+def response_error(model, response, outcome):
+    try:
+        detail = response.json().get("errors") or response.text
+    except ValueError:
+        detail = response.text
+    return WorkersAIError(
+        f"{model}: HTTP {response.status_code}: {detail}",
+        status=response.status_code,
+        retry_after=retry_after_seconds(response),
+        retryable=outcome != "client_errors",
+    )
+
+def retry_delay(scheduler, error, attempt):
+    """Seconds to wait before attempt number `attempt` (from 1), or None to give up.
+
+    Full jitter keeps retrying callers from arriving in lockstep; a Retry-After pause
+    is enforced for everyone by the model's token bucket, so it is not slept here.
+    """
+    if not error.retryable or attempt > config.get("upstream_max_retries", 3):
+        return None
+    if error.retry_after and error.retry_after > config.get("upstream_max_retry_after_s", 30):
+        return None
+    scheduler.record_retry()
+    cap = min(config.get("upstream_retry_max_s", 20), config.get("upstream_retry_base_s", 0.5) * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+class WorkersAIClient:
+    """Pooled async client for the Workers AI ai/run/{model} endpoint."""
+
+    def __init__(self, account_id=ACCOUNT_ID, auth_token=AUTH_TOKEN, api_base=API_BASE):
+        self.base_url = f"{api_base.rstrip('/')}/accounts/{account_id}/ai/run/"
+        self.auth_token = auth_token
+        self._client = None
+
+    @property
+    def started(self):
+        return self._client is not None
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={"Authorization": f"Bearer {self.auth_token}"},
+                http2=http2_available(),
+                timeout=httpx.Timeout(
+                    config.get("workers_ai_timeout_s", 120),
+                    connect=config.get("workers_ai_connect_timeout_s", 10),
+                ),
+                limits=httpx.Limits(
+                    max_connections=config.get("workers_ai_max_connections", 100),
+                    max_keepalive_connections=config.get("workers_ai_max_keepalive_connections", 20),
+                    keepalive_expiry=config.get("workers_ai_keepalive_expiry_s", 30),
+                ),
+            )
+        return self
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _encode(self, payload):
+        # Serialize once so the request size can be recorded without encoding the payload twice
+        body = json.dumps(payload).encode("utf-8")
+        record_size("upstream_request", len(body))
+        return body
+
+    async def run(self, model, payload, lane="interactive"):
+        """POST a payload to a model and return the decoded `result` object.
+
+        Every attempt waits for a slot from the model's scheduler; throttling, 5xx and
+        transport errors are retried with jittered backoff. Raises WorkersAIError, or
+        UpstreamOverloaded when the request is shed.
+        """
+        await self.start()
+        body = self._encode(payload)
+        scheduler = get_upstream_scheduler().model(model)
+        attempt = 0
+        while True:
+            await scheduler.acquire(lane)
+            sent = time.perf_counter()
+            outcome, error = "cancelled", None
+            try:
+                with span("upstream_llm", model=model, streamed=False, attempt=attempt):
+                    response = await self._client.post(self.base_url + model, content=body, headers=JSON_HEADERS)
+                outcome = classify(response)
+                if outcome != "ok":
+                    error = response_error(model, response, outcome)
+            except httpx.TransportError as e:
+                outcome, error = "transport_errors", WorkersAIError(f"{model}: {e!r}", retryable=True)
+            finally:
+                scheduler.release(outcome, time.perf_counter() - sent, error.retry_after if error else None)
+            if error is None:
+                record_size("upstream_response", len(response.content))
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = {}
+                if "result" not in data or not data.get("success", True):
+                    raise WorkersAIError(f"{model}: unsuccessful response: {data.get('errors') or data}", status=response.status_code)
+                return data["result"]
+            attempt += 1
+            delay = retry_delay(scheduler, error, attempt)
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+
+    async def stream(self, model, payload, lane="interactive"):
+        """Run a model with streaming enabled and yield each decoded server-sent event.
+
+        Failed attempts are retried like run() as long as no event has been yielded yet.
+        The slot is held until the stream ends; the time to first event is reported to the
+        scheduler as its load signal.
+        """
+        await self.start()
+        body = self._encode({**payload, "stream": True})
+        scheduler = get_upstream_scheduler().model(model)
+        started = time.perf_counter()
+        first_event_at = None
+        attempt = 0
+        try:
+            while True:
+                await scheduler.acquire(lane)
+                sent = time.perf_counter()
+                outcome, error = "cancelled", None
+                try:
+                    async with self._client.stream("POST", self.base_url + model, content=body, headers=JSON_HEADERS) as response:
+                        outcome = classify(response)
+                        if outcome != "ok":
+                            await response.aread()
+                            error = response_error(model, response, outcome)
+                        else:
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                data = line[len("data:"):].strip()
+                                if data == "[DONE]":
+                                    break
+                                if data:
+                                    if first_event_at is None:
+                                        first_event_at = time.perf_counter()
+                                        observe("upstream_llm_ttft", first_event_at - started, model=model)
+                                    yield json.loads(data)
+                            return
+                except httpx.TransportError as e:
+                    outcome, error = "transport_errors", WorkersAIError(f"{model}: {e!r}", retryable=first_event_at is None)
+                finally:
+                    scheduler.release(
+                        outcome,
+                        time.perf_counter() - sent,
+                        error.retry_after if error else None,
+                        first_token=first_event_at - sent if first_event_at is not None else None,
+                    )
+                attempt += 1
+                delay = retry_delay(scheduler, error, attempt)
+                if delay is None:
+                    raise error
+                await asyncio.sleep(delay)
+        finally:
+            observe("upstream_llm", time.perf_counter() - started, model=model, streamed=True)
+
+class SyncWorkersAIClient:
+    """Blocking facade over WorkersAIClient for synchronous callers such as llm_chains.
+
+    Requests run on a private event loop in a background thread, so the same
+    pooled connections are reused across calls.
+    """
+
+    def __init__(self, client=None):
+        self._client = client or WorkersAIClient()
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="workers-ai-sync", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    def run(self, model, payload, lane="interactive"):
+        return self._call(self._client.run(model, payload, lane))
+
+    def stream(self, model, payload, lane="interactive"):
+        """Blocking generator over the events of WorkersAIClient.stream."""
+        events = queue.Queue()
+
+        async def pump():
+            try:
+                async for event in self._client.stream(model, payload, lane):
+                    events.put(("event", event))
+            except Exception as e:
+                events.put(("error", e))
+            else:
+                events.put(("done", None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._ensure_loop())
+        try:
+            while True:
+                kind, value = events.get()
+                if kind == "event":
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            # Stop pulling from upstream if the consumer stops early
+            future.cancel()
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+
+_client = None
+_sync_client = None
+_clients_lock = threading.Lock()
+
+def get_client():
+    """Return the process-wide async client (started and closed by the FastAPI app)."""
+    global _client
+    with _clients_lock:
+        if _client is None:
+            _client = WorkersAIClient()
+        return _client
+
+def get_sync_client():
+    """Return the process-wide blocking client."""
+    global _sync_client
+    with _clients_lock:
+        if _sync_client is None:
+            _sync_client = SyncWorkersAIClient()
+        return _sync_client
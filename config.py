@@ -0,0 +1,18 @@
+import os
+import yaml
+
+def config_path():
+    """RAG_CONFIG if set, else config.yaml in the working directory, else the one next to this module."""
+    path = os.getenv("RAG_CONFIG")
+    if path:
+        return path
+    if os.path.exists("config.yaml"):
+        return "config.yaml"
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")
+
+def load_config(path=None):
+    with open(path or config_path(), "r") as f:
+        return yaml.safe_load(f)
+
+# Read once per process; every module shares this dict
+config = load_config()
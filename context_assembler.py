@@ -0,0 +1,204 @@
+import logging
+import threading
+from metrics import record_tokens, span
+from config import config
+
+# How far back into a chunk to look for the start of the next one (pdf_handler overlaps by up to 50 chars)
+MERGE_WINDOW = 200
+# Shortest shared text that counts as an overlap between chunks not known to be adjacent
+MIN_OVERLAP = 20
+BLOCK_SEPARATOR = "\n\n---\n\n"
+
+logger = logging.getLogger(__name__)
+
+class Tokenizer:
+    """Token counting with tiktoken encodings (e.g. cl100k_base) or any Hugging Face tokenizer name.
+
+    tiktoken and Hugging Face both download their vocabularies on first use. If neither
+    can be loaded (no network, bad name), counts fall back to the ~4 characters per
+    token approximation so that budgeting degrades instead of failing requests.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._encoding = None
+        self._tokenizer = None
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(name)
+        except Exception as tiktoken_error:
+            try:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(name)
+            except Exception as e:
+                logger.warning("Could not load tokenizer %r (tiktoken: %s; transformers: %s); approximating 4 characters per token", name, tiktoken_error, e)
+
+    @property
+    def approximate(self):
+        return self._encoding is None and self._tokenizer is None
+
+    def encode(self, text):
+        if self._encoding is not None:
+            return self._encoding.encode(text, disallowed_special=())
+        if self._tokenizer is not None:
+            return self._tokenizer.encode(text, add_special_tokens=False)
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens):
+        if self._encoding is not None:
+            return self._encoding.decode(tokens)
+        if self._tokenizer is not None:
+            return self._tokenizer.decode(tokens)
+        return "".join(tokens)
+
+    def count(self, text):
+        return len(self.encode(text))
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """Return the process-wide tokenizer used to budget prompts."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            _tokenizer = Tokenizer(config.get("context_tokenizer", "cl100k_base"))
+        return _tokenizer
+
+def tokenizer_loaded():
+    return _tokenizer is not None
+
+def overlap_length(left, right, min_overlap=1):
+    """Length of the longest suffix of left that is also a prefix of right, searched within MERGE_WINDOW.
+
+    Overlaps shorter than the 8-character probe are not detected.
+    """
+    head = right[:8]
+    if not head:
+        return 0
+    start = left.find(head, max(0, len(left) - MERGE_WINDOW))
+    while start != -1:
+        if right.startswith(left[start:]):
+            length = len(left) - start
+            return length if length >= min_overlap else 0
+        start = left.find(head, start + 1)
+    return 0
+
+def query_rows(results):
+    """Flatten the first row of a Chroma query result into chunk dicts, most relevant first."""
+    documents = results["documents"][0]
+    ids = results["ids"][0]
+    metadatas = (results.get("metadatas") or [[None] * len(documents)])[0]
+    distances = (results.get("distances") or [[None] * len(documents)])[0]
+    return [
+        {"id": chunk_id, "text": text, "metadata": metadata or {}, "distance": distance, "rank": rank}
+        for rank, (chunk_id, text, metadata, distance) in enumerate(zip(ids, documents, metadatas, distances))
+        if text
+    ]
+
+def dedup_chunks(chunks):
+    """Drop exact repeats and chunks wholly contained in a more relevant one."""
+    kept = []
+    for chunk in chunks:
+        if any(chunk["text"] in other["text"] for other in kept):
+            continue
+        kept = [other for other in kept if other["text"] not in chunk["text"]] + [chunk]
+    return sorted(kept, key=lambda chunk: chunk["rank"])
+
+def _join(left, right, adjacent):
+    overlap = overlap_length(left["text"], right["text"], 1 if adjacent else MIN_OVERLAP)
+    if overlap:
+        return left["text"] + right["text"][overlap:]
+    if adjacent:
+        return left["text"] + "\n" + right["text"]
+    return None
+
+def merge_chunks(chunks):
+    """Merge chunks of the same document that are adjacent (by chunk_index) or overlap textually.
+
+    Each merged block keeps the best rank of its parts.
+    """
+    blocks = [
+        {**chunk, "ids": [chunk["id"]], "first": chunk["metadata"].get("chunk_index"), "last": chunk["metadata"].get("chunk_index")}
+        for chunk in chunks
+    ]
+    merged = True
+    while merged:
+        merged = False
+        for i, left in enumerate(blocks):
+            for j, right in enumerate(blocks):
+                if i == j or left["metadata"].get("source") != right["metadata"].get("source"):
+                    continue
+                adjacent = left["last"] is not None and right["first"] is not None and right["first"] == left["last"] + 1
+                text = _join(left, right, adjacent)
+                if text is None:
+                    continue
+                left.update(
+                    text=text,
+                    ids=left["ids"] + right["ids"],
+                    rank=min(left["rank"], right["rank"]),
+                    last=right["last"] if right["last"] is not None else left["last"],
+                )
+                del blocks[j]
+                merged = True
+                break
+            if merged:
+                break
+    return sorted(blocks, key=lambda block: block["rank"])
+
+def format_block(block):
+    source = block["metadata"].get("source")
+    return f"[Source: {source}]\n{block['text']}" if source else block["text"]
+
+def pack_blocks(blocks, max_tokens, tokenizer, min_truncated_tokens=64):
+    """Greedily fit blocks, most relevant first, into max_tokens.
+
+    A block that doesn't fit is truncated if at least min_truncated_tokens remain,
+    otherwise skipped in favour of smaller, less relevant blocks.
+    """
+    separator_tokens = tokenizer.count(BLOCK_SEPARATOR)
+    packed, used, truncated = [], 0, 0
+    for block in blocks:
+        remaining = max_tokens - used - (separator_tokens if packed else 0)
+        if remaining <= 0:
+            break
+        tokens = tokenizer.encode(format_block(block))
+        if len(tokens) > remaining:
+            if remaining < min_truncated_tokens:
+                continue
+            tokens = tokens[:remaining]
+            truncated += 1
+        packed.append((block, tokenizer.decode(tokens)))
+        used += len(tokens) + (separator_tokens if len(packed) > 1 else 0)
+    return packed, used, truncated
+
+def assemble_context(results, max_tokens=None, tokenizer=None):
+    """Turn a Chroma query result into a compact, token-budgeted context string.
+
+    Returns a dict with the context text, the number of tokens it takes, the ids of the
+    chunks that made it in, and counts for retrieved chunks, blocks and truncations.
+    """
+    max_tokens = max_tokens or config.get("context_max_tokens", 2000)
+    tokenizer = tokenizer or get_tokenizer()
+    with span("context_assembly") as attributes:
+        chunks = query_rows(results)
+        blocks = merge_chunks(dedup_chunks(chunks))
+        packed, _, truncated = pack_blocks(blocks, max_tokens, tokenizer, config.get("context_min_truncated_tokens", 64))
+        text = BLOCK_SEPARATOR.join(text for _, text in packed)
+        # Count the joined text once more: tokens can merge across block boundaries
+        tokens = tokenizer.count(text)
+        attributes.update(retrieved=len(chunks), blocks=len(packed), tokens=tokens)
+    record_tokens("context", tokens)
+    return {
+        "text": text,
+        "tokens": tokens,
+        "chunk_ids": [chunk_id for block, _ in packed for chunk_id in block["ids"]],
+        "retrieved": len(chunks),
+        "blocks": len(packed),
+        "truncated": truncated,
+    }
+
+def count_message_tokens(messages, tokenizer=None):
+    """Tokens in the content of a chat message list (role markup excluded)."""
+    tokenizer = tokenizer or get_tokenizer()
+    return sum(tokenizer.count(message["content"]) for message in messages if isinstance(message.get("content"), str))
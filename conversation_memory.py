@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cloudflare_client import get_sync_client
+from context_assembler import get_tokenizer
+from metrics import record_tokens, span
+from prompt_templates import memory_summary_prompt_template
+from session_store import SessionStore
+from config import config
+
+logger = logging.getLogger(__name__)
+
+ROLES = {"human": "user", "ai": "assistant"}
+
+class Conversation:
+    """In-memory view of one chat: its rolling summary plus the messages it doesn't cover yet."""
+
+    def __init__(self, session_id, summary="", summary_tokens=0, summarized_through=-1, messages=None):
+        self.session_id = session_id
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.summarized_through = summarized_through
+        self.messages = messages or []  # {"type", "content", "seq", "tokens"}, oldest first
+        self.compacting = False
+        self.lock = threading.Lock()
+
+class ConversationMemory:
+    """Per-chat_id conversation memory kept under a fixed token ceiling.
+
+    Recent messages are sent verbatim; once they outgrow the space left after the
+    summary's reservation, the oldest are folded into a rolling summary by the LLM in
+    the background. Conversations live in an LRU and are reloaded from the session
+    store (messages plus the persisted summary) after eviction or a restart.
+    """
+
+    def __init__(self, store, tokenizer, summarize, max_tokens=1500, summary_max_tokens=300, max_entries=256, load_limit=200, session_prefix="api_chat_"):
+        self.store = store
+        self.tokenizer = tokenizer
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.max_entries = max_entries
+        self.load_limit = load_limit
+        self.session_prefix = session_prefix
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        # One compaction at a time keeps summarization from competing with live requests upstream
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-compact")
+
+    def session_id(self, chat_id):
+        return f"{self.session_prefix}{chat_id}"
+
+    def _message(self, message, seq):
+        return {"type": message["type"], "content": str(message["content"]), "seq": seq, "tokens": self.tokenizer.count(str(message["content"]))}
+
+    def _get(self, chat_id):
+        with self._lock:
+            conversation = self._conversations.get(chat_id)
+            if conversation is not None:
+                self._conversations.move_to_end(chat_id)
+                return conversation
+            session_id = self.session_id(chat_id)
+            summary = self.store.get_summary(session_id) or {"summary": "", "through_seq": -1}
+            messages = [
+                self._message(message, message["seq"])
+                for message in self.store.load_messages(session_id, limit=self.load_limit)
+                if message["seq"] > summary["through_seq"]
+            ]
+            conversation = self._conversations[chat_id] = Conversation(
+                session_id,
+                summary["summary"],
+                self.tokenizer.count(summary["summary"]) if summary["summary"] else 0,
+                summary["through_seq"],
+                messages,
+            )
+            while len(self._conversations) > self.max_entries:
+                self._conversations.popitem(last=False)
+            return conversation
+
+    def _split(self, conversation):
+        """Split messages into (older, recent): recent fills the budget left after the summary reservation."""
+        budget = self.max_tokens - self.summary_max_tokens
+        count = 0
+        for message in reversed(conversation.messages):
+            if message["tokens"] > budget:
+                break
+            budget -= message["tokens"]
+            count += 1
+        older, recent = conversation.messages[:len(conversation.messages) - count], conversation.messages[len(conversation.messages) - count:]
+        # Start the verbatim part on a human turn
+        while recent and recent[0]["type"] != "human":
+            older, recent = older + recent[:1], recent[1:]
+        return older, recent
+
+    def _history(self, chat_id):
+        conversation = self._get(chat_id)
+        with conversation.lock:
+            _, recent = self._split(conversation)
+            messages = []
+            tokens = 0
+            if conversation.summary:
+                messages.append({"role": "system", "content": f"Summary of the earlier conversation: {conversation.summary}"})
+                tokens += conversation.summary_tokens
+            messages.extend({"role": ROLES.get(message["type"], "user"), "content": message["content"]} for message in recent)
+            tokens += sum(message["tokens"] for message in recent)
+        return messages, tokens
+
+    def history(self, chat_id):
+        """Chat messages (summary first, then recent turns) to put between the system prompt and the new input."""
+        messages, tokens = self._history(chat_id)
+        record_tokens("memory", tokens)
+        return messages
+
+    def fingerprint(self, chat_id):
+        """Digest of what history() currently returns, for keying anything that depends on it."""
+        messages, _ = self._history(chat_id)
+        return hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def append(self, chat_id, human, ai):
+        """Persist one exchange and schedule compaction if older messages no longer fit verbatim."""
+        conversation = self._get(chat_id)
+        turn = [{"type": "human", "content": human}, {"type": "ai", "content": ai}]
+        with conversation.lock:
+            seqs = self.store.append_messages(conversation.session_id, turn)
+            conversation.messages.extend(self._message(message, seq) for message, seq in zip(turn, seqs))
+            older, _ = self._split(conversation)
+            if older and not conversation.compacting:
+                conversation.compacting = True
+                self._executor.submit(self._compact, conversation, older[-1]["seq"])
+
+    def _compact(self, conversation, through_seq):
+        try:
+            with conversation.lock:
+                folded = [message for message in conversation.messages if message["seq"] <= through_seq]
+                previous = conversation.summary
+            if not folded:
+                return
+            transcript = "\n".join(f"{'Human' if message['type'] == 'human' else 'AI'}: {message['content']}" for message in folded)
+            prompt = memory_summary_prompt_template.format(summary=previous or "(none)", conversation=transcript)
+            with span("memory_summarize", messages=len(folded)):
+                summary = self.summarize(prompt, self.summary_max_tokens).strip()
+            tokens = self.tokenizer.encode(summary)
+            if len(tokens) > self.summary_max_tokens:
+                summary = self.tokenizer.decode(tokens[:self.summary_max_tokens])
+                tokens = tokens[:self.summary_max_tokens]
+            self.store.set_summary(conversation.session_id, summary, through_seq)
+            with conversation.lock:
+                conversation.summary = summary
+                conversation.summary_tokens = len(tokens)
+                conversation.summarized_through = through_seq
+                conversation.messages = [message for message in conversation.messages if message["seq"] > through_seq]
+        except Exception:
+            # The older turns stay out of the prompt until the next exchange retries
+            logger.exception("Summarizing %s failed", conversation.session_id)
+        finally:
+            conversation.compacting = False
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def summarize_with_llm(prompt, max_tokens):
+    result = get_sync_client().run(
+        config["llm_model"],
+        {"messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens},
+        lane="bulk",
+    )
+    return result["response"]
+
+_memory = None
+_memory_lock = threading.Lock()
+
+def get_conversation_memory():
+    """Return the process-wide conversation memory, or None when it is disabled in config.yaml."""
+    global _memory
+    if not config.get("memory_enabled", True):
+        return None
+    with _memory_lock:
+        if _memory is None:
+            _memory = ConversationMemory(
+                # A store of its own, so API memory never shows up in GET /sessions or the app's session list
+                store=SessionStore(config.get("memory_store_path", "./chat_sessions/memory.sqlite3")),
+                tokenizer=get_tokenizer(),
+                summarize=summarize_with_llm,
+                max_tokens=config.get("memory_max_tokens", 1500),
+                summary_max_tokens=config.get("memory_summary_max_tokens", 300),
+                max_entries=config.get("memory_cache_max_entries", 256),
+                load_limit=config.get("memory_load_limit", 200),
+                session_prefix=config.get("memory_session_prefix", "api_chat_"),
+            )
+        return _memory
+
+def shutdown_conversation_memory():
+    """Stop the memory's background summarization, if the memory was ever created."""
+    if _memory is not None:
+        _memory.shutdown()
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from metrics import span
+from config import config
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """On-disk (model, text hash) -> float32 vector cache with an entry cap and LRU eviction."""
+
+    def __init__(self, path, max_entries=200000):
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, last_access REAL NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, hashes):
+        """Return {text_hash: vector} for the hashes present in the cache and mark them as used."""
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, model, items):
+        """Store (text_hash, vector) pairs, evicting the least recently used entries past the cap."""
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+                [(model, key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items],
+            )
+            self._count += self._conn.total_changes - before
+            if self._count > self.max_entries:
+                # Evict down to 90% of the cap so eviction doesn't run on every insert
+                excess = self._count - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)",
+                    (excess,),
+                )
+                self._count -= excess
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class EmbeddingEngine:
+    """Batched sentence-transformers embedder behind an EmbeddingCache. Returns normalized float32 vectors."""
+
+    def __init__(self, model_name, batch_size=64, cache=None, device=None, backend="torch", threads=0):
+        self.model_name = model_name
+        self.backend = backend
+        self.threads = threads
+        # Quantized backends give slightly different vectors, so they get their own cache entries
+        self.cache_key = model_name if backend == "torch" else f"{model_name}:{backend}"
+        self.batch_size = batch_size
+        self.cache = cache
+        self.device = device
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                from inference_backend import load_sentence_transformer
+                self._model = load_sentence_transformer(self.model_name, self.backend, self.device, self.threads)
+        return self._model
+
+    def encode(self, texts):
+        """Embed texts without the cache."""
+        texts = list(texts)
+        model = self.load()
+        with span("embedding", texts=len(texts)):
+            vectors = model.encode(
+                texts,
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+        return np.asarray(vectors, dtype=np.float32)
+
+    def embed(self, texts):
+        """Return a (len(texts), dim) float32 array, embedding only texts not seen before."""
+        texts = list(texts)
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.cache_key, list(set(hashes))) if self.cache else {}
+        # Each distinct missing text is embedded once, however often it repeats
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            encoded = self.encode(missing.values())
+            new_items = list(zip(missing.keys(), encoded))
+            vectors.update(new_items)
+            if self.cache:
+                self.cache.put_many(self.cache_key, new_items)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in hashes])
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_embedding_engine():
+    """Return the process-wide embedding engine for the configured model."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = EmbeddingEngine(
+                model_name=config["embeddings_path"],
+                batch_size=config.get("embedding_batch_size", 64),
+                backend=config.get("embedding_backend", "torch"),
+                threads=config.get("embedding_threads", 0),
+                cache=EmbeddingCache(
+                    config.get("embedding_cache_path", "./embedding_cache.sqlite3"),
+                    max_entries=config.get("embedding_cache_max_entries", 200000),
+                ),
+            )
+        return _engine
+
+def embedding_engine_loaded():
+    """Whether the engine exists and has its model loaded; never creates it."""
+    return _engine is not None and _engine.loaded
+
+def embed_texts(texts):
+    """Embed texts with the shared engine and return them as lists, the form Chroma accepts."""
+    return get_embedding_engine().embed(texts).tolist()
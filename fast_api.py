@@ -1,28 +1,40 @@
-from io import BytesIO
+import asyncio
+import logging
+import json
+import math
 import os
+import time
 from typing import Optional
-import requests
-import yaml
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from PIL import Image
-import chromadb
-from pdf_handler import create_embeddings, load_vectordb, add_to_db
-from image_handler import image_to_int_array
-from audio_handler import transcribe_audio
+from ingest_jobs import get_ingest_queue, QueueFull
+from image_handler import preprocess_image
+from audio_handler import get_transcription_engine, stop_transcription_engine, transcription_engine_loaded, submit_audio, join_transcripts, pcm_to_float32, StreamingTranscriber
+from cloudflare_client import WorkersAIError, get_client
+from upstream_scheduler import LANES, UpstreamOverloaded, get_upstream_scheduler
+from retrieval_dispatcher import get_retrieval_dispatcher
+from answer_cache import get_answer_cache
+from embedding_handler import embedding_engine_loaded, get_embedding_engine
+from vector_store import connected, health_check
+from session_store import get_session_store
+from context_assembler import assemble_context, count_message_tokens, get_tokenizer, tokenizer_loaded
+from conversation_memory import get_conversation_memory, shutdown_conversation_memory
+from lifecycle import get_lifecycle_manager
+from metrics import TraceMiddleware, record_tokens, register_gauge, render_prometheus, span
+from config import config
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID")
 AUTH_TOKEN = os.getenv("CLOUDFLARE_AUTH_TOKEN")
 API_ID = os.getenv("CLOUDFLARE_AI_API")
 
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
-
 models = config["llm_model"]
 image_model = config["Image_model"]
 
@@ -33,12 +45,18 @@ class ChatRequest(BaseModel):
     user_id: int
     input: str
     transcribe: Optional[str] = None
+    stream: bool = False
 
 class ChatPdfRequest(BaseModel):
     chat_id: int
     user_id: int
     input: str
     doc_path: Optional[str] = None
+    stream: bool = False
+
+class IngestJobRequest(BaseModel):
+    chat_id: int
+    doc_path: str
 
 class HandleImageRequest(BaseModel):
     user_message: str
@@ -54,6 +72,208 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TraceMiddleware)
+
+def answer_cache_counts():
+    cache = get_answer_cache()
+    if cache is None:
+        return {}
+    stats = cache.get_stats()
+    return {(("result", key),): stats[key] for key in ("exact_hits", "similarity_hits", "misses")}
+
+register_gauge("rag_answer_cache_lookups", "Answer cache lookups by result since startup.", answer_cache_counts)
+register_gauge(
+    "rag_retrieval_dispatcher_total",
+    "Retrieval dispatcher counters since startup.",
+    lambda: {(("counter", key),): value for key, value in get_retrieval_dispatcher().stats.items()},
+)
+register_gauge(
+    "rag_vector_lifecycle_total",
+    "Vector store lifecycle counters since startup.",
+    lambda: {(("counter", key),): value for key, value in get_lifecycle_manager().stats.items()},
+)
+register_gauge(
+    "rag_upstream_queue_depth",
+    "Requests waiting for an upstream slot, by model and lane.",
+    lambda: {
+        (("model", model), ("lane", lane)): stats["queue_depth"][lane]
+        for model, stats in get_upstream_scheduler().snapshot().items()
+        for lane in LANES
+    },
+)
+register_gauge(
+    "rag_upstream_scheduler",
+    "Upstream scheduler state (in_flight, concurrency_limit) and counters since startup, by model.",
+    lambda: {
+        (("model", model), ("field", key)): value
+        for model, stats in get_upstream_scheduler().snapshot().items()
+        for key, value in stats.items()
+        if isinstance(value, (int, float))
+    },
+)
+register_gauge("rag_ingest_queue_depth", "Ingest jobs waiting for a worker.", lambda: get_ingest_queue().stats()["queue_depth"])
+
+# Engines that load on first use, as name -> (load, is_loaded); any of them can be listed under prewarm.
+# is_loaded only inspects the singletons, so probes never create an engine (or its cache file).
+ENGINES = {
+    "whisper": (lambda: get_transcription_engine().load(), transcription_engine_loaded),
+    "embeddings": (lambda: get_embedding_engine().load(), embedding_engine_loaded),
+    "tokenizer": (get_tokenizer, tokenizer_loaded),
+    "vector_store": (health_check, connected),
+}
+
+prewarm_status = {}
+prewarm_tasks = set()
+
+async def prewarm(name):
+    load, _ = ENGINES[name]
+    try:
+        await run_in_threadpool(load)
+    except Exception as e:
+        prewarm_status[name] = f"failed: {e}"
+        logger.exception("Prewarming %s failed; it will load on first use instead", name)
+        return
+    prewarm_status[name] = "ready"
+    logger.info("Prewarmed %s", name)
+
+@app.exception_handler(UpstreamOverloaded)
+async def upstream_overloaded(request: Request, exc: UpstreamOverloaded):
+    # Shed before reaching Workers AI; the client should back off and retry
+    return JSONResponse(content={"error": str(exc)}, status_code=503, headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+@app.exception_handler(WorkersAIError)
+async def upstream_failed(request: Request, exc: WorkersAIError):
+    headers = {"Retry-After": str(math.ceil(exc.retry_after))} if exc.retry_after else None
+    return JSONResponse(content={"error": str(exc)}, status_code=502, headers=headers)
+
+@app.on_event("startup")
+async def startup():
+    get_retrieval_dispatcher().start()
+    if config.get("lifecycle_enabled", True):
+        get_lifecycle_manager().start()
+    await get_client().start()
+    # Load the listed engines in the background; startup itself never waits on a model
+    for name in config.get("prewarm") or []:
+        if name not in ENGINES:
+            logger.warning("Unknown prewarm engine %r; expected one of %s", name, ", ".join(ENGINES))
+            continue
+        prewarm_status[name] = "loading"
+        task = asyncio.create_task(prewarm(name))
+        prewarm_tasks.add(task)
+        task.add_done_callback(prewarm_tasks.discard)
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Stop only what was started; shutting down must not build engines, stores or tokenizers
+    stop_transcription_engine()
+    get_retrieval_dispatcher().stop()
+    if config.get("lifecycle_enabled", True):
+        get_lifecycle_manager().stop()
+    get_ingest_queue().shutdown()
+    shutdown_conversation_memory()
+    await get_client().aclose()
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_completion(model, payload, on_complete=None, summary=None):
+    """Proxy a streaming Workers AI run as SSE token events plus a final summary event.
+
+    on_complete is called (in the threadpool) with the full response text once the stream
+    finishes cleanly; summary holds extra fields for the final event.
+    """
+    started = time.perf_counter()
+    first_token_ms = None
+    usage = None
+    tokens = []
+    try:
+        async for event in get_client().stream(model, payload):
+            if event.get("usage"):
+                usage = event["usage"]
+            token = event.get("response")
+            if not token:
+                continue
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - started) * 1000
+            tokens.append(token)
+            yield sse_event("token", {"response": token})
+    except Exception as e:
+        retry_after = getattr(e, "retry_after", None)
+        yield sse_event("error", {"error": str(e), **({"retry_after": retry_after} if retry_after else {})})
+        return
+    response_content = "".join(tokens)
+    if on_complete is not None:
+        await run_in_threadpool(on_complete, response_content)
+    yield sse_event("done", {
+        "usage": usage,
+        "time_to_first_token_ms": first_token_ms,
+        "total_ms": (time.perf_counter() - started) * 1000,
+        "response_chars": len(response_content),
+        "cached": False,
+        **(summary or {}),
+    })
+
+async def stream_cached(response_content):
+    yield sse_event("token", {"response": response_content})
+    yield sse_event("done", {
+        "usage": None,
+        "time_to_first_token_ms": 0.0,
+        "total_ms": 0.0,
+        "response_chars": len(response_content),
+        "cached": True,
+    })
+
+def streaming_response(model, payload, on_complete=None, summary=None):
+    return StreamingResponse(
+        stream_completion(model, payload, on_complete, summary),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def cached_streaming_response(response_content):
+    return StreamingResponse(
+        stream_cached(response_content),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def chat_payload(request, history=()):
+    return {
+        "messages": [
+            {"role": "system", "content": "You are a friendly assistant"},
+            *history,
+            {"role": "user", "content": request.input},
+        ]
+    }
+
+async def memory_history(chat_id):
+    """Summary and recent turns of a chat from the conversation memory (empty when disabled or unavailable)."""
+    try:
+        memory = get_conversation_memory()
+        if memory is None:
+            return []
+        return await run_in_threadpool(memory.history, chat_id)
+    except Exception:
+        # Memory only adds context; answer without it rather than failing the chat
+        logger.exception("Conversation memory unavailable for chat %s", chat_id)
+        return []
+
+def memory_fingerprint(chat_id):
+    """Fingerprint of a chat's conversation memory ("" when disabled or unavailable)."""
+    try:
+        memory = get_conversation_memory()
+        return memory.fingerprint(chat_id) if memory is not None else ""
+    except Exception:
+        logger.exception("Conversation memory unavailable for chat %s", chat_id)
+        return ""
+
+def remember_turn(chat_id, human, ai):
+    try:
+        memory = get_conversation_memory()
+        if memory is not None:
+            memory.append(chat_id, human, ai)
+    except Exception:
+        logger.exception("Could not record turn in conversation memory for chat %s", chat_id)
 
 @app.post("/chat")
 async def chat(request: ChatRequest):
@@ -82,69 +302,174 @@ async def chat(request: ChatRequest):
             }
         )
 
+    payload = chat_payload(request, await memory_history(request.chat_id))
 
-    response = requests.post(
-        f"https://api.cloudflare.com/client/v4/accounts/{ACCOUNT_ID}/ai/run/{models}",
-        headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-        json={
-            "messages": [
-                {"role": "system", "content": "You are a friendly assistant"},
-                {"role": "user", "content": request.input},
-            ]
-        },
-    )
+    def remember(response_content):
+        remember_turn(request.chat_id, request.input, response_content)
 
-    response_content = response.json()['result']['response']
+    if request.stream:
+        return streaming_response(models, payload, on_complete=remember)
+
+    result = await get_client().run(models, payload)
+
+    response_content = result['response']
+    await run_in_threadpool(remember, response_content)
     history.append({"role": "assistant", "content": response_content})
     return JSONResponse(content={"response": response_content})
 
 @app.post("/chat_pdf")
 async def chat_pdf(request: ChatPdfRequest):
-    client = chromadb.HttpClient(host='localhost', port=9000)
-    collection = client.get_or_create_collection(name="test")
     history = []
 
+    # Ingest new documents in the background and answer from whatever is already indexed
+    extra = {}
     if request.doc_path:
-        add_to_db(request.doc_path, request.chat_id, collection)
+        try:
+            extra["ingest_job"] = get_ingest_queue().submit(request.chat_id, request.doc_path).to_dict()
+        except QueueFull as e:
+            extra["ingest_job"] = {"error": str(e)}
+
+    # Concurrent requests share one embedding pass and one query per chat (see retrieval_dispatcher)
+    n_results = config.get("context_n_results", 8)
+    with span("retrieval", n_results=n_results):
+        future = get_retrieval_dispatcher().submit(request.chat_id, request.input, n_results)
+        retrieved = await asyncio.shield(asyncio.wrap_future(future))
+    results = retrieved["results"]
+    query_embeddings = [retrieved["embedding"]]
+    chunk_ids = results["ids"][0]
 
-    vector_data = collection.query(query_texts=[request.input], n_results=5, where={"chat_id": request.chat_id})["documents"]
+    # Answers are keyed on the retrieved chunks, so they go stale as soon as the documents change,
+    # and on the conversation memory sent with the question, so earlier turns are never ignored
+    conversation = await memory_history(request.chat_id)
+    cache = get_answer_cache()
+    if cache is not None:
+        fingerprint = await run_in_threadpool(memory_fingerprint, request.chat_id)
+        cached_response = cache.get(request.input, models, chunk_ids, query_embeddings[0], fingerprint)
+        if cached_response is not None:
+            if request.stream:
+                return with_ingest_job_header(cached_streaming_response(cached_response), extra)
+            return JSONResponse(content={"response": cached_response, "cached": True, **extra})
 
+    def remember(response_content):
+        remember_turn(request.chat_id, request.input, response_content)
+        if cache is not None:
+            # Keyed on the memory as it stands after this turn: that is what a repeat of the question is asked with
+            cache.put(request.input, models, chunk_ids, response_content, query_embeddings[0], memory_fingerprint(request.chat_id))
+
+    # Deduplicated, merged and packed into the token budget instead of the raw result lists
+    context = await run_in_threadpool(assemble_context, results)
     history.append(
         {
             "role": "system",
-            "content": f"You are a friendly assistant, generate responses based on the user's input, document data, and the context of the conversation. Context: {vector_data}",
+            "content": f"You are a friendly assistant, generate responses based on the user's input, document data, and the context of the conversation. Context:\n{context['text']}",
         }
     )
     
-    response = requests.post(
-        f"https://api.cloudflare.com/client/v4/accounts/{ACCOUNT_ID}/ai/run/{models}",
-        headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-        json={
-            "messages": history + [
-                {"role": "user", "content": request.input},
-            ]
-        },
-    )
+    payload = {
+        "messages": history + conversation + [
+            {"role": "user", "content": request.input},
+        ]
+    }
+    tokens = {"context_tokens": context["tokens"], "prompt_tokens": await run_in_threadpool(count_message_tokens, payload["messages"])}
+    record_tokens("prompt", tokens["prompt_tokens"])
+    if request.stream:
+        return with_ingest_job_header(streaming_response(models, payload, on_complete=remember, summary=tokens), extra)
 
-    response_content = response.json()['result']['response']
+    result = await get_client().run(models, payload)
+
+    response_content = result['response']
+    await run_in_threadpool(remember, response_content)
     history.append({"role": "assistant", "content": response_content})
-    return JSONResponse(content={"response": response_content})
+    return JSONResponse(content={"response": response_content, "cached": False, **tokens, **extra})
+
+def with_ingest_job_header(response, extra):
+    job_id = extra.get("ingest_job", {}).get("job_id")
+    if job_id:
+        response.headers["X-Ingest-Job-Id"] = job_id
+    return response
+
+@app.post("/ingest_jobs")
+async def submit_ingest_job(request: IngestJobRequest):
+    try:
+        job = get_ingest_queue().submit(request.chat_id, request.doc_path)
+    except QueueFull as e:
+        return JSONResponse(content={"error": str(e)}, status_code=429, headers={"Retry-After": "5"})
+    return JSONResponse(content=job.to_dict(), status_code=202)
+
+@app.get("/ingest_jobs")
+async def ingest_jobs_stats():
+    return JSONResponse(content=get_ingest_queue().stats())
+
+@app.get("/ingest_jobs/{job_id}")
+async def ingest_job_status(job_id: str):
+    job = get_ingest_queue().get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return JSONResponse(content=job.to_dict())
+
+@app.delete("/ingest_jobs/{job_id}")
+async def cancel_ingest_job(job_id: str):
+    job = get_ingest_queue().cancel(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return JSONResponse(content=job.to_dict())
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving requests."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the upstream client is open and every prewarmed engine has loaded (by prewarm or on first use)."""
+    engines = {name: is_loaded() for name, (_, is_loaded) in ENGINES.items()}
+    pending = [name for name, status in prewarm_status.items() if status != "ready" and not engines[name]]
+    ready = get_client().started and not pending
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "upstream_client": get_client().started,
+        "engines": engines,
+        "prewarm": prewarm_status,
+    }
+    return JSONResponse(content=body, status_code=200 if ready else 503)
+
+@app.get("/cache_stats")
+async def cache_stats():
+    cache = get_answer_cache()
+    return JSONResponse(content={"answer_cache": cache.get_stats() if cache is not None else None})
+
+@app.get("/upstream_stats")
+async def upstream_stats():
+    return JSONResponse(content=get_upstream_scheduler().snapshot())
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/sessions")
+async def list_sessions(limit: int = 50):
+    sessions = await run_in_threadpool(get_session_store().list_sessions, limit)
+    return JSONResponse(content={"sessions": sessions})
+
+@app.get("/sessions/{session_id}/messages")
+async def session_messages(session_id: str, limit: int = 50, before_seq: Optional[int] = None):
+    messages = await run_in_threadpool(get_session_store().load_messages, session_id, limit, before_seq)
+    # The first message's seq is the cursor for the previous page
+    return JSONResponse(content={"messages": messages, "before_seq": messages[0]["seq"] if messages else None})
 
 @app.post("/handle_image")
 async def handle_image(image_path: UploadFile = File(...), user_message: str = ""):
     try:
         # Read the uploaded file
         img_file = await image_path.read()
-        img = Image.open(BytesIO(img_file))
-        
-        # Convert the image to an integer array
-        img = image_to_int_array(img)
+
+        # Downscale and re-encode into the compact payload (CPU-bound, so off the event loop)
+        img = await run_in_threadpool(preprocess_image, img_file)
         
-        # Make the request to Cloudflare API
-        response = requests.post(
-            f"https://api.cloudflare.com/client/v4/accounts/{ACCOUNT_ID}/ai/run/{image_model}",
-            headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-            json={
+        # Make the request to Cloudflare API (raises for bad responses)
+        result = await get_client().run(
+            image_model,
+            {
                 "messages": [
                     {
                         "role": "system",
@@ -156,20 +481,145 @@ async def handle_image(image_path: UploadFile = File(...), user_message: str = "
             },
         )
 
-        response.raise_for_status()  # Raise an error for bad responses
-        response_content = response.json().get('result', {}).get('response', 'No response from the model.')
+        response_content = (result or {}).get('response', 'No response from the model.')
         
         return JSONResponse(content={"response": response_content})
 
+    except (WorkersAIError, UpstreamOverloaded):
+        raise
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 @app.post("/transcribe_audio")
 async def transcribe_audio_endpoint(audio_file: UploadFile = File(...)):
     audio_bytes = await audio_file.read()
-    transcribe = transcribe_audio(audio_bytes)
+    futures = await run_in_threadpool(submit_audio, audio_bytes)
+    transcribe = join_transcripts(await asyncio.gather(*(asyncio.wrap_future(future) for future in futures)))
     return JSONResponse(content={"transcription": transcribe})
 
+@app.websocket("/ws/transcribe")
+async def transcribe_stream(
+    websocket: WebSocket,
+    sample_format: str = "f32le",
+    forward_to_chat: bool = False,
+    chat_id: int = 0,
+    user_id: int = 0,
+):
+    """Transcribe audio while it is being recorded.
+
+    The client sends binary frames of 16 kHz mono PCM (sample_format f32le or s16le) and
+    a text frame {"type": "stop"} when recording ends. The server replies with
+    {"type": "partial"} previews of the open window, {"type": "final"} segments as windows
+    complete, and {"type": "done"} with the full transcript. With forward_to_chat the
+    transcript is then sent through the /chat flow and streamed back as {"type": "chat_token"}
+    messages followed by {"type": "chat_done"}.
+
+    On failure the server sends {"type": "error"} and closes the socket: with 1003 for
+    frames it cannot read, 1011 when transcription or the forwarded chat fails.
+    """
+    await websocket.accept()
+    engine = get_transcription_engine()
+    transcriber = StreamingTranscriber()
+    send_lock = asyncio.Lock()
+    finals = asyncio.Queue()
+    partial_task = None
+
+    async def send(message):
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def fail(code, error):
+        retry_after = getattr(error, "retry_after", None)
+        try:
+            await send({"type": "error", "error": str(error), **({"retry_after": retry_after} if retry_after else {})})
+            await websocket.close(code=code)
+        except Exception:
+            # The client is already gone
+            pass
+
+    async def run_partial(audio):
+        try:
+            text = await asyncio.wrap_future(engine.submit(audio))
+        except Exception:
+            # Partials are only previews; the same failure surfaces on the next final segment
+            return
+        await send({"type": "partial", "text": transcriber.preview(text)})
+
+    async def run_finals():
+        # Final segments are transcribed strictly in order so overlap merging stays correct
+        while True:
+            segment = await finals.get()
+            if segment is None:
+                return
+            start, end, audio = segment
+            text = await asyncio.wrap_future(engine.submit(audio))
+            await send({"type": "final", "text": transcriber.merge(text), "start": start, "end": end})
+
+    if sample_format not in ("f32le", "s16le"):
+        await fail(1003, f"Unsupported sample format: {sample_format}")
+        return
+
+    finalizer = asyncio.create_task(run_finals())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect()
+            if finalizer.done():
+                # Transcribing a final segment failed; raise it now rather than after "stop"
+                finalizer.result()
+            if message.get("bytes"):
+                for segment in transcriber.feed(pcm_to_float32(message["bytes"], sample_format)):
+                    finals.put_nowait(segment)
+                if transcriber.partial_due() and (partial_task is None or partial_task.done()):
+                    partial_task = asyncio.create_task(run_partial(transcriber.take_partial()))
+            elif message.get("text"):
+                try:
+                    control = json.loads(message["text"])
+                except json.JSONDecodeError as e:
+                    await fail(1003, f"Invalid control message: {e}")
+                    return
+                if not isinstance(control, dict):
+                    await fail(1003, "Control messages must be JSON objects")
+                    return
+                if control.get("type") == "stop":
+                    break
+
+        if partial_task is not None:
+            partial_task.cancel()
+        segment = transcriber.flush()
+        if segment is not None:
+            finals.put_nowait(segment)
+        finals.put_nowait(None)
+        await finalizer
+        transcript = transcriber.transcript
+        await send({"type": "done", "transcript": transcript})
+
+        if forward_to_chat and transcript:
+            payload = chat_payload(
+                ChatRequest(chat_id=chat_id, user_id=user_id, input=transcript, transcribe=transcript),
+                await memory_history(chat_id),
+            )
+            tokens = []
+            async for event in get_client().stream(models, payload):
+                token = event.get("response")
+                if token:
+                    tokens.append(token)
+                    await send({"type": "chat_token", "response": token})
+            await run_in_threadpool(remember_turn, chat_id, transcript, "".join(tokens))
+            await send({"type": "chat_done", "response": "".join(tokens)})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        # Engine, decoding and upstream (WorkersAIError, UpstreamOverloaded) failures end the stream with an error frame
+        logger.exception("Transcription stream failed")
+        await fail(1011, e)
+    finally:
+        for task in (partial_task, finalizer):
+            if task is not None and not task.done():
+                task.cancel()
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,8 +1,12 @@
+import base64
+import hashlib
 import io
 import os
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
-import yaml
-from PIL import Image
+from metrics import record_size, span
+from config import config
 
 load_dotenv()
 
@@ -12,3 +16,82 @@ def image_to_int_array(image, format="JPEG"):
     image.save(bytes, format=format)
     return list(bytes.getvalue())
 
+def to_rgb(image):
+    """Convert any mode to RGB, flattening transparency onto white (JPEG has no alpha or palette)."""
+    from PIL import Image
+    if image.mode == "RGB":
+        return image
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def downscale(image, max_side):
+    """Shrink so the longest side is at most max_side; the vision model never sees more than that."""
+    from PIL import Image
+    if max(image.size) <= max_side:
+        return image
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    return image
+
+def encode_jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def encode_within_budget(image, max_bytes, min_quality=40, max_quality=90):
+    """Encode as JPEG at the highest quality that fits max_bytes, shrinking the image if even min_quality doesn't."""
+    from PIL import Image
+    while True:
+        low, high, best = min_quality, max_quality, None
+        while low <= high:
+            quality = (low + high) // 2
+            data = encode_jpeg(image, quality)
+            if len(data) <= max_bytes:
+                best, low = data, quality + 1
+            else:
+                high = quality - 1
+        if best is not None or max(image.size) <= 64:
+            return best if best is not None else encode_jpeg(image, min_quality)
+        image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+def to_payload(jpeg_bytes, payload_format=None):
+    """Shape encoded bytes the way the API accepts them: a base64 string, or the legacy integer list."""
+    payload_format = payload_format or config.get("image_payload_format", "base64")
+    if payload_format == "int_array":
+        return list(jpeg_bytes)
+    return base64.b64encode(jpeg_bytes).decode("ascii")
+
+_payload_cache = OrderedDict()
+_payload_cache_lock = threading.Lock()
+
+def preprocess_image(image_bytes):
+    """Turn raw upload bytes into the compact image payload for the vision model, cached by content hash."""
+    max_side = config.get("image_max_side", 1120)
+    max_bytes = config.get("image_max_bytes", 300000)
+    min_quality = config.get("image_min_quality", 40)
+    max_quality = config.get("image_max_quality", 90)
+    payload_format = config.get("image_payload_format", "base64")
+    key = hashlib.sha256(image_bytes).hexdigest() + f":{max_side}:{max_bytes}:{min_quality}:{max_quality}:{payload_format}"
+    with _payload_cache_lock:
+        if key in _payload_cache:
+            _payload_cache.move_to_end(key)
+            return _payload_cache[key]
+
+    record_size("image_upload", len(image_bytes))
+    # PIL is only imported once an image actually needs decoding
+    from PIL import Image
+    with span("image_preprocess"):
+        image = downscale(to_rgb(Image.open(io.BytesIO(image_bytes))), max_side)
+        payload = to_payload(encode_within_budget(image, max_bytes, min_quality, max_quality), payload_format)
+    record_size("image_payload", len(payload))
+
+    with _payload_cache_lock:
+        _payload_cache[key] = payload
+        while len(_payload_cache) > config.get("image_cache_max_entries", 128):
+            _payload_cache.popitem(last=False)
+    return payload
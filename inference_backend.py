@@ -0,0 +1,152 @@
+import os
+import re
+import shutil
+import threading
+from config import config
+
+# torch: fp32 eager PyTorch. torch_int8: Linear layers dynamically quantized to int8 (CPU).
+# onnx / onnx_int8: the model exported once to ONNX (fp32 or int8 dynamic-quantized) and run by ONNX Runtime.
+BACKENDS = ("torch", "torch_int8", "onnx", "onnx_int8")
+# Transcription and embeddings can run at the same time, so a thread setting of 0 gives each half the cores
+ENGINE_SHARES = 2
+
+_torch_threads_lock = threading.Lock()
+_torch_threads_configured = False
+_export_lock = threading.Lock()
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+    return backend
+
+def default_threads():
+    """One engine's share of the cores, used wherever a thread setting is 0."""
+    return max(1, (os.cpu_count() or 1) // ENGINE_SHARES)
+
+def configure_torch_threads(threads=None):
+    """Size torch's intra-op thread pool once per process and return its size.
+
+    The pool is shared by every torch model in the process, so it is set from
+    inference_torch_threads rather than per engine; 0 takes default_threads().
+    """
+    global _torch_threads_configured
+    import torch
+    threads = (config.get("inference_torch_threads", 0) if threads is None else threads) or default_threads()
+    with _torch_threads_lock:
+        if not _torch_threads_configured:
+            torch.set_num_threads(threads)
+            _torch_threads_configured = True
+    return torch.get_num_threads()
+
+def quantize_torch(model):
+    """int8 dynamic quantization of every Linear layer; weights are stored int8, activations quantized per batch."""
+    import torch
+    return torch.ao.quantization.quantize_dynamic(model.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8)
+
+def session_options(threads=0):
+    """ONNX Runtime options for one engine: its own intra-op pool of `threads` (0 = default_threads()), no inter-op pool."""
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("The onnx backends need optimum[onnxruntime] (pip install 'optimum[onnxruntime]')") from e
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads or default_threads()
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+def quantize_onnx_dir(source, target):
+    """Copy an exported model directory, replacing each .onnx graph with its int8 dynamic-quantized version."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    staging = target + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    shutil.copytree(source, staging, ignore=shutil.ignore_patterns("*.onnx", "*.onnx_data"))
+    for root, _, files in os.walk(source):
+        for name in files:
+            if name.endswith(".onnx"):
+                path = os.path.join(root, name)
+                output = os.path.join(staging, os.path.relpath(path, source))
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                quantize_dynamic(path, output, weight_type=QuantType.QInt8)
+    os.replace(staging, target)
+
+def onnx_model_dir(model_name, kind, export, quantized=False):
+    """Directory holding the ONNX export of a model, exporting (and quantizing) it on first use.
+
+    export(directory) writes the fp32 export; the int8 variant is derived from it.
+    Exports live under inference_export_dir and are reused across restarts.
+    """
+    root = config.get("inference_export_dir", "./onnx_models")
+    path = os.path.join(root, f"{kind}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)}")
+    with _export_lock:
+        if not os.path.isdir(path):
+            staging = path + ".tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            export(staging)
+            os.replace(staging, path)
+        if not quantized:
+            return path
+        quantized_path = path + "-int8"
+        if not os.path.isdir(quantized_path):
+            quantize_onnx_dir(path, quantized_path)
+        return quantized_path
+
+def load_whisper(model_name, backend="torch", device=None, threads=0):
+    """Build the automatic-speech-recognition pipeline for model_name on the given backend."""
+    from transformers import pipeline
+    check_backend(backend)
+    if backend in ("torch", "torch_int8"):
+        import torch
+        configure_torch_threads()
+        if backend == "torch_int8":
+            device = "cpu"
+        elif device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        pipe = pipeline(task="automatic-speech-recognition", model=model_name, chunk_length_s=30, device=device)
+        if backend == "torch_int8":
+            pipe.model = quantize_torch(pipe.model)
+        return pipe
+
+    options = session_options(threads)
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+    from transformers import AutoProcessor
+
+    def export(directory):
+        ORTModelForSpeechSeq2Seq.from_pretrained(model_name, export=True).save_pretrained(directory)
+        AutoProcessor.from_pretrained(model_name).save_pretrained(directory)
+
+    path = onnx_model_dir(model_name, "whisper", export, quantized=backend == "onnx_int8")
+    processor = AutoProcessor.from_pretrained(path)
+    model = ORTModelForSpeechSeq2Seq.from_pretrained(path, provider="CPUExecutionProvider", session_options=options)
+    return pipeline(
+        task="automatic-speech-recognition",
+        model=model,
+        tokenizer=processor.tokenizer,
+        feature_extractor=processor.feature_extractor,
+        chunk_length_s=30,
+    )
+
+def load_sentence_transformer(model_name, backend="torch", device=None, threads=0):
+    """Build a SentenceTransformer for model_name on the given backend; encode() works the same on all of them."""
+    from sentence_transformers import SentenceTransformer
+    check_backend(backend)
+    if backend in ("torch", "torch_int8"):
+        configure_torch_threads()
+        if backend == "torch":
+            return SentenceTransformer(model_name, device=device)
+        return quantize_torch(SentenceTransformer(model_name, device="cpu"))
+
+    options = session_options(threads)
+
+    def export(directory):
+        SentenceTransformer(model_name, backend="onnx", device="cpu").save_pretrained(directory)
+
+    path = onnx_model_dir(model_name, "embedding", export, quantized=backend == "onnx_int8")
+    return SentenceTransformer(
+        path,
+        backend="onnx",
+        device="cpu",
+        model_kwargs={"provider": "CPUExecutionProvider", "session_options": options},
+    )
@@ -0,0 +1,54 @@
+import argparse
+import glob
+import os
+import time
+from pdf_handler import add_pdfs_to_db
+from vector_store import get_collection, get_chat_collection
+
+def collect_pdf_paths(paths):
+    """Expand directories into the PDFs they contain."""
+    pdf_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdf_paths.extend(sorted(glob.glob(os.path.join(path, "**", "*.pdf"), recursive=True)))
+        else:
+            pdf_paths.append(path)
+    return pdf_paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest PDFs into the vector store.")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories containing PDFs")
+    parser.add_argument("--chat-id", required=True, help="chat the documents belong to")
+    parser.add_argument("--collection", default=None, help="target collection (default: the chat's own partition)")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes (default: ingest_workers, or the CPU count split across ingest_job_workers)")
+    parser.add_argument("--batch-size", type=int, default=None, help="chunks per collection.add call")
+    args = parser.parse_args()
+
+    # chat ids are integers in the API, keep them that way so metadata filters match
+    chat_id = int(args.chat_id) if args.chat_id.isdigit() else args.chat_id
+    pdf_paths = collect_pdf_paths(args.paths)
+    collection = get_collection(args.collection) if args.collection else get_chat_collection(chat_id)
+
+    started = time.perf_counter()
+    reports = add_pdfs_to_db(pdf_paths, chat_id, collection, max_workers=args.workers, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - started
+
+    for report in reports:
+        if report["skipped"]:
+            print(f"{report['source']}: already ingested, skipped")
+            continue
+        print(
+            f"{report['source']}: {report['pages']} pages, {report['chunks']} chunks, "
+            f"extract {report['extract_seconds']:.2f}s, chunk {report['chunk_seconds']:.2f}s, write {report['write_seconds']:.2f}s, "
+            f"{report['pages_per_second']:.1f} pages/s"
+        )
+    total_pages = sum(report["pages"] for report in reports)
+    total_chunks = sum(report["chunks"] for report in reports)
+    skipped = sum(report["skipped"] for report in reports)
+    print(
+        f"Ingested {len(reports) - skipped} files, skipped {skipped} ({total_pages} pages, {total_chunks} new chunks) in {elapsed:.2f}s, "
+        f"{total_pages / elapsed if elapsed else 0:.1f} pages/s"
+    )
+
+if __name__ == "__main__":
+    main()
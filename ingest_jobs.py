@@ -0,0 +1,146 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from pdf_handler import add_to_db, IngestCancelled, IngestProgress
+from config import config
+
+class QueueFull(Exception):
+    """Raised when the ingestion queue is at capacity; callers should retry later."""
+
+class IngestJob(IngestProgress):
+    """One document ingestion, tracked from submission to completion."""
+
+    def __init__(self, chat_id, doc_path):
+        self.id = uuid4().hex
+        self.chat_id = chat_id
+        self.doc_path = doc_path
+        self.status = "queued"
+        self.pages_processed = 0
+        self.chunks_written = 0
+        self.error = None
+        self.report = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, pages=0, chunks=0):
+        with self._lock:
+            self.pages_processed += pages
+            self.chunks_written += chunks
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise IngestCancelled(self.id)
+
+    @property
+    def done(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "chat_id": self.chat_id,
+                "doc_path": self.doc_path,
+                "status": self.status,
+                "pages_processed": self.pages_processed,
+                "chunks_written": self.chunks_written,
+                "error": self.error,
+                "report": self.report,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+class IngestJobQueue:
+    """Bounded worker pool for ingestion jobs with status tracking, cancellation and backpressure."""
+
+    def __init__(self, workers=2, max_queue_depth=32, retention_s=3600):
+        self.max_queue_depth = max_queue_depth
+        self.retention_s = retention_s
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_s
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status == "queued")
+
+    def submit(self, chat_id, doc_path):
+        """Queue an ingestion and return its job. An identical job still in flight is returned instead."""
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if not job.done and job.chat_id == chat_id and job.doc_path == doc_path:
+                    return job
+            if sum(1 for job in self._jobs.values() if job.status == "queued") >= self.max_queue_depth:
+                raise QueueFull(f"{self.max_queue_depth} ingestion jobs already queued")
+            job = IngestJob(chat_id, doc_path)
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(self._run, job)
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued job immediately, or ask a running one to stop at its next batch."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job._cancelled.set()
+        if job.future.cancel():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"queue_depth": counts.get("queued", 0), "max_queue_depth": self.max_queue_depth, "jobs": counts}
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            job._cancelled.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.report = add_to_db(job.doc_path, job.chat_id, progress=job)
+            job.status = "succeeded"
+        except IngestCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_ingest_queue():
+    """Return the process-wide ingestion job queue."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = IngestJobQueue(
+                workers=config.get("ingest_job_workers", 2),
+                max_queue_depth=config.get("ingest_job_max_queue_depth", 32),
+                retention_s=config.get("ingest_job_retention_s", 3600),
+            )
+        return _queue
@@ -0,0 +1,56 @@
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+from config import config
+
+def manifest_path(chat_id):
+    safe_chat_id = re.sub(r"[^A-Za-z0-9_.-]", "_", str(chat_id))
+    return os.path.join(config.get("ingest_manifest_path", "./ingest_manifests/"), f"{safe_chat_id}.json")
+
+def load_manifest(chat_id):
+    """Return the manifest of documents ingested for a chat.
+
+    Layout: {"documents": {source: {"hash", "chunking", "chunk_ids", "ingested_at"}}}
+    """
+    try:
+        with open(manifest_path(chat_id), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"documents": {}}
+
+def save_manifest(chat_id, manifest):
+    """Atomically replace the manifest file for a chat."""
+    path = manifest_path(chat_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def ingested_hashes(manifest, chunking):
+    """Document hashes already ingested with the given chunking signature."""
+    return {
+        entry["hash"]
+        for entry in manifest["documents"].values()
+        if entry.get("chunking") == chunking
+    }
+
+def record_document(manifest, source, doc_hash, chunking, chunk_ids):
+    """Record a document and return chunk ids of its previous version that nothing references anymore."""
+    previous = manifest["documents"].get(source)
+    manifest["documents"][source] = {
+        "hash": doc_hash,
+        "chunking": chunking,
+        "chunk_ids": chunk_ids,
+        "ingested_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    if previous is None:
+        return []
+    referenced = {chunk_id for entry in manifest["documents"].values() for chunk_id in entry["chunk_ids"]}
+    return [chunk_id for chunk_id in previous["chunk_ids"] if chunk_id not in referenced]
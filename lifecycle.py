@@ -0,0 +1,543 @@
+import argparse
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from ingest_manifest import load_manifest, save_manifest, manifest_path
+from vector_store import CollectionHandle, get_client, invalidate_collection, partition_lock, partition_name
+from config import config
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_LEASE = "maintenance"
+
+class MaintenanceBusy(Exception):
+    """Another process holds the maintenance lease."""
+
+class LifecycleStore:
+    """Per-chat bookkeeping on SQLite: last access and chunks deleted since the partition was last rebuilt."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "chat_id TEXT PRIMARY KEY, last_access REAL NOT NULL, deleted_chunks INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._conn.commit()
+
+    def touch_many(self, accesses):
+        """Record {chat_id: timestamp}, never moving a last access backwards."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO chats (chat_id, last_access) VALUES (?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET last_access = MAX(last_access, excluded.last_access)",
+                [(str(chat_id), timestamp) for chat_id, timestamp in accesses.items()],
+            )
+
+    def get_all(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, last_access, deleted_chunks FROM chats").fetchall()
+        return {row[0]: {"last_access": row[1], "deleted_chunks": row[2]} for row in rows}
+
+    def add_deleted(self, chat_id, count):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE chats SET deleted_chunks = deleted_chunks + ? WHERE chat_id = ?", (count, str(chat_id)))
+
+    def reset_deleted(self, chat_id):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE chats SET deleted_chunks = 0 WHERE chat_id = ?", (str(chat_id),))
+
+    def forget(self, chat_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chats WHERE chat_id = ?", (str(chat_id),))
+
+    def acquire_lease(self, name, owner, ttl_s):
+        """Take or extend a lease unless another owner holds it unexpired. Returns whether owner now holds it.
+
+        Every process using the same lifecycle_path sees the same leases.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl_s, now),
+            )
+            row = self._conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def release_lease(self, name, owner):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class LifecycleManager:
+    """Keeps the vector store bounded: TTL expiry, per-chat and global chunk quotas, and index rebuilds.
+
+    Accesses are buffered in memory and written at most every touch_flush_s. A sweep drops
+    expired chats, trims chats over their quota by evicting their oldest documents, drops the
+    least recently used chats while the store is over the global quota, and rebuilds
+    partitions that have accumulated many deletions (HNSW only marks deleted vectors).
+    Each sweep deletes at most max_deletes chunks and max_chats chats, in batches.
+    Every change to a partition is made under its exclusive partition_lock; a chat that
+    stays busy for lock_timeout_s is skipped until the next sweep. Sweeps, rebuilds and
+    drops also hold a lease in the lifecycle store, so only one process (API worker, app
+    or CLI) maintains the store at a time; the others skip their sweeps meanwhile.
+    """
+
+    def __init__(self, store, chat_ttl_s=2592000, max_chunks_per_chat=50000, max_chunks_total=1000000,
+                 max_deletes=5000, max_chats=10, batch_size=256, batch_pause_s=0.05, rebuild_ratio=0.2,
+                 touch_flush_s=30, interval_s=600, lock_timeout_s=30, lease_ttl_s=600):
+        self.store = store
+        self.chat_ttl_s = chat_ttl_s
+        self.max_chunks_per_chat = max_chunks_per_chat
+        self.max_chunks_total = max_chunks_total
+        self.max_deletes = max_deletes
+        self.max_chats = max_chats
+        self.batch_size = batch_size
+        self.batch_pause_s = batch_pause_s
+        self.rebuild_ratio = rebuild_ratio
+        self.touch_flush_s = touch_flush_s
+        self.interval_s = interval_s
+        self.lock_timeout_s = lock_timeout_s
+        self.lease_ttl_s = lease_ttl_s
+        self.stats = {"sweeps": 0, "chats_dropped": 0, "chunks_evicted": 0, "rebuilds": 0, "busy_skips": 0, "lease_skips": 0}
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._pending_lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self._maintenance_lock = threading.RLock()
+        self._lease_depth = 0
+        self._lease_renewed = 0.0
+        self._stop = threading.Event()
+        self._worker = None
+
+    def touch(self, chat_id):
+        """Note that a chat was used. Cheap enough for every query."""
+        with self._pending_lock:
+            self._pending[str(chat_id)] = time.time()
+            due = time.monotonic() - self._last_flush >= self.touch_flush_s
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if pending:
+            self.store.touch_many(pending)
+
+    @contextmanager
+    def maintenance(self):
+        """Hold the maintenance lease (re-entrant). Raises MaintenanceBusy while another process holds it."""
+        with self._maintenance_lock:
+            if not self._lease_depth:
+                if not self.store.acquire_lease(MAINTENANCE_LEASE, self._owner, self.lease_ttl_s):
+                    raise MaintenanceBusy("Another process is maintaining the vector store")
+                self._lease_renewed = time.monotonic()
+            self._lease_depth += 1
+            try:
+                yield
+            finally:
+                self._lease_depth -= 1
+                if not self._lease_depth:
+                    self.store.release_lease(MAINTENANCE_LEASE, self._owner)
+
+    def _renew_lease(self):
+        # Long rebuilds and evictions outlive one lease period
+        if self._lease_depth and time.monotonic() - self._lease_renewed > self.lease_ttl_s / 3:
+            if not self.store.acquire_lease(MAINTENANCE_LEASE, self._owner, self.lease_ttl_s):
+                raise RuntimeError("Lost the maintenance lease to another process")
+            self._lease_renewed = time.monotonic()
+
+    def chat_partitions(self):
+        """One row per chat partition: chat id, collection name, chunk count and lifecycle state."""
+        prefix = config.get("vector_store_partition_prefix", "chat_")
+        known = self.store.get_all()
+        unseen = {}
+        chats = []
+        for item in get_client().list_collections():
+            name = getattr(item, "name", item)
+            if not name.startswith(prefix) or name.startswith(rebuild_prefix()):
+                continue
+            collection = existing_collection(get_client(), name)
+            if collection is None:
+                continue
+            chat_id = (collection.metadata or {}).get("chat_id", name[len(prefix):])
+            state = known.get(str(chat_id))
+            if state is None:
+                # Chats from before tracking started get a full TTL from now
+                state = {"last_access": time.time(), "deleted_chunks": 0}
+                unseen[str(chat_id)] = state["last_access"]
+            chats.append({"chat_id": str(chat_id), "collection": name, "chunks": collection.count(), **state})
+        if unseen:
+            self.store.touch_many(unseen)
+        return chats
+
+    def report(self):
+        now = time.time()
+        rows = []
+        for chat in sorted(self.chat_partitions(), key=lambda chat: -chat["chunks"]):
+            documents = load_manifest(chat["chat_id"])["documents"]
+            rows.append({
+                **chat,
+                "documents": len(documents),
+                "idle_days": (now - chat["last_access"]) / 86400,
+                "over_quota": bool(self.max_chunks_per_chat) and chat["chunks"] > self.max_chunks_per_chat,
+                "expired": bool(self.chat_ttl_s) and now - chat["last_access"] > self.chat_ttl_s,
+            })
+        return rows
+
+    def sweep(self, dry_run=False):
+        """Run one bounded eviction pass and return the actions taken (or planned, with dry_run).
+
+        Returns no actions, without sweeping, while another process holds the maintenance lease.
+        """
+        with self._sweep_lock:
+            if dry_run:
+                return self._sweep(dry_run)
+            try:
+                with self.maintenance():
+                    return self._sweep(dry_run)
+            except MaintenanceBusy:
+                logger.info("Another process is maintaining the vector store; skipping this sweep")
+                self.stats["lease_skips"] += 1
+                return []
+
+    def _sweep(self, dry_run):
+        self.flush()
+        if not dry_run:
+            self.recover_leftovers()
+        now = time.time()
+        chats = sorted(self.chat_partitions(), key=lambda chat: chat["last_access"])
+        actions = []
+        dropped = set()
+        deletes_left = self.max_deletes
+
+        def busy(chat, action):
+            logger.info("Chat %s is busy; skipping %s until the next sweep", chat["chat_id"], action)
+            self.stats["busy_skips"] += 1
+
+        def drop(chat, reason):
+            if not dry_run:
+                try:
+                    self.drop_chat(chat["chat_id"], chat["collection"])
+                except TimeoutError:
+                    busy(chat, "drop_chat")
+                    return False
+            actions.append({"action": "drop_chat", "chat_id": chat["chat_id"], "chunks": chat["chunks"], "reason": reason})
+            dropped.add(chat["chat_id"])
+            return True
+
+        for chat in chats:
+            if len(dropped) >= self.max_chats:
+                break
+            if self.chat_ttl_s and now - chat["last_access"] > self.chat_ttl_s:
+                drop(chat, "expired")
+
+        for chat in chats:
+            if chat["chat_id"] in dropped or not self.max_chunks_per_chat or chat["chunks"] <= self.max_chunks_per_chat:
+                continue
+            if deletes_left <= 0:
+                break
+            try:
+                evicted = self.evict_oldest_documents(chat, chat["chunks"] - self.max_chunks_per_chat, deletes_left, dry_run)
+            except TimeoutError:
+                busy(chat, "evict_documents")
+                continue
+            deletes_left -= evicted["chunks"]
+            chat["chunks"] -= evicted["chunks"]
+            chat["deleted_chunks"] += evicted["chunks"]
+            actions.append({"action": "evict_documents", "chat_id": chat["chat_id"], **evicted, "reason": "chat_quota"})
+
+        total = sum(chat["chunks"] for chat in chats if chat["chat_id"] not in dropped)
+        for chat in chats:
+            if not self.max_chunks_total or total <= self.max_chunks_total or len(dropped) >= self.max_chats:
+                break
+            if chat["chat_id"] not in dropped and drop(chat, "global_quota"):
+                total -= chat["chunks"]
+
+        for chat in chats:
+            if chat["chat_id"] in dropped or not chat["deleted_chunks"]:
+                continue
+            if chat["deleted_chunks"] / max(1, chat["chunks"] + chat["deleted_chunks"]) >= self.rebuild_ratio:
+                if not dry_run:
+                    try:
+                        self.rebuild(chat["chat_id"])
+                    except TimeoutError:
+                        busy(chat, "rebuild")
+                        continue
+                actions.append({"action": "rebuild", "chat_id": chat["chat_id"], "chunks": chat["chunks"]})
+
+        if not dry_run:
+            self.stats["sweeps"] += 1
+            for action in actions:
+                if action["action"] == "drop_chat":
+                    self.stats["chats_dropped"] += 1
+                elif action["action"] == "evict_documents":
+                    self.stats["chunks_evicted"] += action["chunks"]
+                else:
+                    self.stats["rebuilds"] += 1
+        return actions
+
+    def drop_chat(self, chat_id, name=None):
+        """Delete a chat's partition and its manifest. Dropping the collection frees its index outright."""
+        name = name or partition_name(chat_id)
+        with self.maintenance(), partition_lock(chat_id).exclusive(self.lock_timeout_s):
+            get_client().delete_collection(name)
+            invalidate_collection(name)
+            try:
+                os.remove(manifest_path(chat_id))
+            except FileNotFoundError:
+                pass
+        self.store.forget(chat_id)
+
+    def evict_oldest_documents(self, chat, excess, max_chunks, dry_run=False):
+        """Remove whole documents, oldest ingestion first, until `excess` chunks are gone or max_chunks is spent.
+
+        The manifest is read and written under the chat's exclusive lock, so it can't
+        race an ingestion's copy of it.
+        """
+        if dry_run:
+            return self._evict(chat, load_manifest(chat["chat_id"]), excess, max_chunks, dry_run)
+        with partition_lock(chat["chat_id"]).exclusive(self.lock_timeout_s):
+            return self._evict(chat, load_manifest(chat["chat_id"]), excess, max_chunks, dry_run)
+
+    def _evict(self, chat, manifest, excess, max_chunks, dry_run):
+        documents = manifest["documents"]
+        order = sorted(documents, key=lambda source: documents[source].get("ingested_at", ""))
+        evicted = {"documents": [], "chunks": 0}
+        for source in order:
+            if evicted["chunks"] >= excess:
+                break
+            referenced = {chunk_id for other, entry in documents.items() if other != source for chunk_id in entry["chunk_ids"]}
+            ids = [chunk_id for chunk_id in documents[source]["chunk_ids"] if chunk_id not in referenced]
+            if evicted["chunks"] + len(ids) > max_chunks:
+                break
+            if not dry_run:
+                self.delete_chunks(chat["collection"], ids)
+                del documents[source]
+                save_manifest(chat["chat_id"], manifest)
+                self.store.add_deleted(chat["chat_id"], len(ids))
+            evicted["documents"].append(source)
+            evicted["chunks"] += len(ids)
+        return evicted
+
+    def delete_chunks(self, name, ids):
+        collection = CollectionHandle(name)
+        for start in range(0, len(ids), self.batch_size):
+            self._renew_lease()
+            collection.delete(ids=ids[start:start + self.batch_size])
+            # Leave room for live queries between batches
+            time.sleep(self.batch_pause_s)
+
+    def rebuild(self, chat_id, page_size=None):
+        """Copy a partition into a fresh collection and swap it in, leaving deleted vectors behind.
+
+        Runs under the maintenance lease and the chat's exclusive lock, so nothing in this
+        process writes or queries it meanwhile. The live partition is renamed aside rather
+        than deleted until the copy has taken its name; if the swap fails (say another
+        process recreated the partition empty in between), recover() puts the original back.
+        Other processes' cached handles go stale and are refreshed on their next call.
+        """
+        page_size = page_size or self.batch_size
+        name = partition_name(chat_id)
+        temp_name, backup_name = rebuild_names(name)
+        client = get_client()
+        with self.maintenance(), partition_lock(chat_id).exclusive(self.lock_timeout_s):
+            self.recover(chat_id)
+            source = client.get_collection(name)
+            target = client.create_collection(name=temp_name, metadata=source.metadata)
+            offset = 0
+            while True:
+                page = source.get(include=["documents", "metadatas", "embeddings"], limit=page_size, offset=offset)
+                if not page["ids"]:
+                    break
+                offset += len(page["ids"])
+                target.add(
+                    ids=page["ids"],
+                    documents=page["documents"],
+                    metadatas=page["metadatas"],
+                    embeddings=[list(vector) for vector in page["embeddings"]],
+                )
+                time.sleep(self.batch_pause_s)
+                self._renew_lease()
+            if target.count() != source.count():
+                client.delete_collection(temp_name)
+                raise RuntimeError(f"Rebuilding {name}: copy has {target.count()} of {source.count()} chunks; left the partition as it was")
+
+            invalidate_collection(name)
+            source.modify(name=backup_name)
+            try:
+                target.modify(name=name)
+            except Exception:
+                logger.exception("Rebuilding %s: swapping in the copy failed; restoring the original", name)
+                self.recover(chat_id)
+                raise
+            client.delete_collection(backup_name)
+            invalidate_collection(name)
+        self.store.reset_deleted(chat_id)
+
+    def recover_leftovers(self):
+        """Run recover() for every chat with collections left by an interrupted rebuild."""
+        chat_ids = set()
+        for item in get_client().list_collections():
+            name = getattr(item, "name", item)
+            if name.startswith(rebuild_prefix()):
+                collection = existing_collection(get_client(), name)
+                if collection is not None and (collection.metadata or {}).get("chat_id") is not None:
+                    chat_ids.add(collection.metadata["chat_id"])
+        for chat_id in chat_ids:
+            try:
+                self.recover(chat_id)
+            except Exception:
+                logger.exception("Recovering the partition of chat %s failed", chat_id)
+
+    def recover(self, chat_id):
+        """Resolve collections left behind by an interrupted rebuild without losing chunks.
+
+        A partition that is missing (or empty) gets its data back from the renamed-aside
+        original, or failing that from the copy; leftovers are deleted only once the
+        partition holds at least as many chunks as they do.
+        """
+        name = partition_name(chat_id)
+        temp_name, backup_name = rebuild_names(name)
+        client = get_client()
+        with partition_lock(chat_id).exclusive(self.lock_timeout_s):
+            current, temp, backup = (existing_collection(client, n) for n in (name, temp_name, backup_name))
+            if current is not None and current.count() == 0 and any(leftover is not None and leftover.count() for leftover in (backup, temp)):
+                # Recreated empty by a request that landed mid-swap; the leftover has the real data
+                client.delete_collection(name)
+                invalidate_collection(name)
+                current = None
+            if current is None:
+                for leftover in (backup, temp):
+                    if leftover is not None:
+                        logger.warning("Restoring %s from %s", name, leftover.name)
+                        leftover.modify(name=name)
+                        invalidate_collection(name)
+                        current = leftover
+                        break
+            for leftover in (backup, temp):
+                if leftover is None or leftover is current:
+                    continue
+                if current is not None and current.count() >= leftover.count():
+                    client.delete_collection(leftover.name)
+                else:
+                    raise RuntimeError(f"{leftover.name} holds more chunks than {name}; resolve it by hand before rebuilding")
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="vector-lifecycle", daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                actions = self.sweep()
+                if actions:
+                    logger.info("Lifecycle sweep: %s", actions)
+            except Exception:
+                logger.exception("Lifecycle sweep failed")
+
+def rebuild_prefix():
+    return config.get("vector_store_partition_prefix", "chat_") + "rebuild_"
+
+def rebuild_names(name):
+    """(copy, renamed-aside original) collection names used while rebuilding a partition."""
+    digest = hashlib.sha256(name.encode("utf-8")).hexdigest()[:24]
+    return rebuild_prefix() + digest, rebuild_prefix() + "old_" + digest
+
+def existing_collection(client, name):
+    """The collection called name, or None; unlike get_collection this never creates it."""
+    try:
+        return client.get_collection(name)
+    except Exception:
+        return None
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_lifecycle_manager():
+    """Return the process-wide lifecycle manager."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = LifecycleManager(
+                LifecycleStore(config.get("lifecycle_path", "./lifecycle.sqlite3")),
+                chat_ttl_s=config.get("lifecycle_chat_ttl_s", 2592000),
+                max_chunks_per_chat=config.get("lifecycle_max_chunks_per_chat", 50000),
+                max_chunks_total=config.get("lifecycle_max_chunks_total", 1000000),
+                max_deletes=config.get("lifecycle_max_deletes_per_sweep", 5000),
+                max_chats=config.get("lifecycle_max_chats_per_sweep", 10),
+                batch_size=config.get("ingest_batch_size", 256),
+                batch_pause_s=config.get("lifecycle_batch_pause_s", 0.05),
+                rebuild_ratio=config.get("lifecycle_rebuild_deleted_ratio", 0.2),
+                touch_flush_s=config.get("lifecycle_touch_flush_s", 30),
+                interval_s=config.get("lifecycle_interval_s", 600),
+                lock_timeout_s=config.get("lifecycle_lock_timeout_s", 30),
+                lease_ttl_s=config.get("lifecycle_lease_ttl_s", 600),
+            )
+        return _manager
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and enforce vector store retention.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("report", help="chunks, documents and idle time per chat")
+    sweep = commands.add_parser("sweep", help="run one eviction pass now")
+    sweep.add_argument("--dry-run", action="store_true", help="only print what would be evicted")
+    rebuild = commands.add_parser("rebuild", help="rebuild one chat's partition")
+    rebuild.add_argument("--chat-id", required=True)
+    args = parser.parse_args()
+
+    manager = get_lifecycle_manager()
+    if args.command == "report":
+        rows = manager.report()
+        for row in rows:
+            flags = " ".join(flag for flag in ("expired", "over_quota") if row[flag])
+            print(
+                f"chat {row['chat_id']}: {row['chunks']} chunks, {row['documents']} documents, "
+                f"idle {row['idle_days']:.1f} days, last access {datetime.fromtimestamp(row['last_access']).isoformat(timespec='seconds')}"
+                + (f" [{flags}]" if flags else "")
+            )
+        print(f"Total: {sum(row['chunks'] for row in rows)} chunks in {len(rows)} chats")
+    elif args.command == "sweep":
+        actions = manager.sweep(dry_run=args.dry_run)
+        for action in actions:
+            print(action)
+        if manager.stats["lease_skips"]:
+            parser.exit(1, "Another process is maintaining the vector store; try again later\n")
+        if not actions:
+            print("Nothing to evict")
+    else:
+        try:
+            manager.rebuild(args.chat_id)
+        except MaintenanceBusy as e:
+            parser.exit(1, f"{e}; try again later\n")
+        print(f"Rebuilt {partition_name(args.chat_id)}")
+
+if __name__ == "__main__":
+    main()
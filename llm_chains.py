@@ -1,26 +1,39 @@
+import logging
 import os
-import requests
-import yaml
-import chromadb
 from dotenv import load_dotenv
 from pdf_handler import create_embeddings, load_vectordb, add_to_db
-from PIL import Image
-from image_handler import image_to_int_array
+from image_handler import preprocess_image
 from audio_handler import transcribe_audio
+from cloudflare_client import get_sync_client
+from retrieval_dispatcher import get_retrieval_dispatcher
+from answer_cache import get_answer_cache
+from context_assembler import assemble_context
+from metrics import span
+from config import config
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID")
 AUTH_TOKEN = os.getenv("CLOUDFLARE_AUTH_TOKEN")
 API_ID = os.getenv("CLOUDFLARE_AI_API")
 
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
-
 models = config["llm_model"]
 image_model = config["Image_model"]
 
-def chat(chat_id, user_id, input, transcribe):
+def stream_response(model, payload, on_complete=None):
+    """Yield response tokens from a streaming Workers AI run."""
+    tokens = []
+    for event in get_sync_client().stream(model, payload):
+        token = event.get("response")
+        if token:
+            tokens.append(token)
+            yield token
+    if on_complete is not None:
+        on_complete("".join(tokens))
+
+def chat(chat_id, user_id, input, transcribe, stream=False):
     history = []
 
     if transcribe:
@@ -46,58 +59,80 @@ def chat(chat_id, user_id, input, transcribe):
             }
         )
 
-    response = requests.post(
-        f"https://api.cloudflare.com/client/v4/accounts/{ACCOUNT_ID}/ai/run/{models}",
-        headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-        json={
-            "messages": [
-                {"role": "system", "content": "You are a friendly assistant"},
-                {"role": "user", "content": input},
-            ]
-        },
-    )
+    payload = {
+        "messages": [
+            {"role": "system", "content": "You are a friendly assistant"},
+            {"role": "user", "content": input},
+        ]
+    }
+    if stream:
+        return stream_response(models, payload)
+
+    result = get_sync_client().run(models, payload)
 
-    print(response.json()['result']['response'])
-    history.append({"role": "assistant", "content": response.json()['result']['response']})
-    return response.json()['result']['response']
+    response_content = result['response']
+    logger.debug("Response: %s", response_content)
+    history.append({"role": "assistant", "content": response_content})
+    return response_content
 
-def chat_pdf(chat_id, user_id, input, doc_path: str | None = None):
-    client = chromadb.HttpClient(host='localhost', port=9000)
-    collection = client.get_or_create_collection(name="test")
+def chat_pdf(chat_id, user_id, input, doc_path: str | None = None, stream=False):
     history = []
 
     if doc_path:
-        add_to_db(doc_path, chat_id, collection)
-
-    vector_data = collection.query(query_texts=[input], n_results=5, where={"chat_id": chat_id})["documents"]
-
+        add_to_db(doc_path, chat_id)
+
+    n_results = config.get("context_n_results", 8)
+    with span("retrieval", n_results=n_results):
+        retrieved = get_retrieval_dispatcher().retrieve(chat_id, input, n_results)
+    results = retrieved["results"]
+    query_embeddings = [retrieved["embedding"]]
+    chunk_ids = results["ids"][0]
+
+    cache = get_answer_cache()
+    if cache is not None:
+        cached_response = cache.get(input, models, chunk_ids, query_embeddings[0])
+        if cached_response is not None:
+            return iter([cached_response]) if stream else cached_response
+
+    def remember(response_content):
+        if cache is not None:
+            cache.put(input, models, chunk_ids, response_content, query_embeddings[0])
+
+    context = assemble_context(results)
+    logger.debug("Context: %d tokens from %d of %d retrieved chunks", context["tokens"], len(context["chunk_ids"]), context["retrieved"])
     history.append(
         {
             "role": "system",
-            "content": f"You are a friendly assistant, generate responses based on the user's input, document data, and the context of the conversation. Context: {vector_data}",
+            "content": f"You are a friendly assistant, generate responses based on the user's input, document data, and the context of the conversation. Context:\n{context['text']}",
         }
     )
-    response = requests.post(
-        f"https://api.cloudflare.com/client/v4/accounts/{ACCOUNT_ID}/ai/run/{models}",
-        headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-        json={
-            "messages": history + [
-                {"role": "user", "content": input},
-            ]
-        },
-    )
-    print(response.json()['result']['response'])
-    history.append({"role": "assistant", "content": response.json()['result']['response']})
-    return response.json()['result']['response']
+    payload = {
+        "messages": history + [
+            {"role": "user", "content": input},
+        ]
+    }
+    if stream:
+        return stream_response(models, payload, on_complete=remember)
+
+    result = get_sync_client().run(models, payload)
+    response_content = result['response']
+    remember(response_content)
+    logger.debug("Response: %s", response_content)
+    history.append({"role": "assistant", "content": response_content})
+    return response_content
 
 def handle_image(image_path, user_message):
-    img = Image.open(image_path)
-    img = image_to_int_array(img)
+    # Accept raw bytes (e.g. a Streamlit upload) as well as a path
+    if isinstance(image_path, (bytes, bytearray)):
+        image_bytes = bytes(image_path)
+    else:
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+    img = preprocess_image(image_bytes)
     # API request to Cloudflare AI (Image description)
-    response = requests.post(
-        f"https://api.cloudflare.com/client/v4/accounts/{ACCOUNT_ID}/ai/run/{image_model}",
-        headers={"Authorization": f"Bearer {AUTH_TOKEN}"},
-        json={
+    result = get_sync_client().run(
+        image_model,
+        {
             "messages": [
                 {
                     "role": "system",
@@ -109,8 +144,9 @@ def handle_image(image_path, user_message):
         },
     )
 
-    print(response.json()['result']['response'])
-    return response.json()['result']['response']
+    response_content = result['response']
+    logger.debug("Response: %s", response_content)
+    return response_content
 
 
 # chat(1, 1, "Hello", None)
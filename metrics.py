@@ -0,0 +1,217 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+from config import config
+
+logger = logging.getLogger("rag.trace")
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values, rendered in Prometheus text format."""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for label_values, series in items:
+            labels = ",".join(f'{key}="{_escape(value)}"' for key, value in zip(self.labels, label_values))
+            prefix = labels + "," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+stage_seconds = Histogram("rag_stage_duration_seconds", "Time spent per processing stage.", ("stage",), LATENCY_BUCKETS)
+payload_bytes = Histogram("rag_payload_bytes", "Size of payloads moved between stages.", ("kind",), SIZE_BUCKETS)
+prompt_tokens = Histogram("rag_prompt_tokens", "Tokens sent upstream, by prompt part.", ("part",), TOKEN_BUCKETS)
+request_seconds = Histogram(
+    "rag_http_request_duration_seconds", "End-to-end HTTP request latency.", ("method", "route", "status"), LATENCY_BUCKETS
+)
+_histograms = [request_seconds, stage_seconds, payload_bytes, prompt_tokens]
+_gauges = []
+
+def register_gauge(name, help, collect):
+    """Expose a value computed at scrape time.
+
+    collect() returns a number, or a dict mapping label tuples such as (("state", "queued"),) to numbers.
+    """
+    _gauges.append((name, help, collect))
+
+class Trace:
+    """Spans and payload sizes recorded while handling one request."""
+
+    def __init__(self, method, path):
+        self.id = uuid4().hex
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans = []
+        self.sizes = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds, attributes):
+        with self._lock:
+            self.spans.append({"stage": name, "ms": round(seconds * 1000, 3), **attributes})
+
+    def add_size(self, kind, size):
+        with self._lock:
+            self.sizes[kind] = self.sizes.get(kind, 0) + size
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.id, "method": self.method, "path": self.path, "spans": list(self.spans), "sizes": dict(self.sizes)}
+
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+
+def start_trace(method, path):
+    trace = Trace(method, path)
+    return trace, _current_trace.set(trace)
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+def current_trace():
+    return _current_trace.get()
+
+def observe(stage, seconds, **attributes):
+    """Record a stage duration in the histogram and on the current request's trace."""
+    stage_seconds.observe(seconds, stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, seconds, attributes)
+
+@contextmanager
+def span(stage, **attributes):
+    """Time a block as one stage. Extra attributes end up on the trace."""
+    started = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        observe(stage, time.perf_counter() - started, **attributes)
+
+def record_size(kind, size):
+    payload_bytes.observe(size, kind)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_size(kind, size)
+
+def record_tokens(part, count):
+    prompt_tokens.observe(count, part)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_size(f"{part}_tokens", count)
+
+def log_trace(trace, status, seconds, route):
+    if random.random() < config.get("trace_log_sample_rate", 1.0):
+        logger.info(json.dumps({**trace.to_dict(), "route": route, "status": status, "duration_ms": round(seconds * 1000, 3)}))
+
+def render_prometheus():
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for name, help, collect in _gauges:
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge"])
+        try:
+            value = collect()
+        except Exception:
+            continue
+        if isinstance(value, dict):
+            for labels, number in value.items():
+                rendered = ",".join(f'{key}="{_escape(label)}"' for key, label in labels)
+                lines.append(f"{name}{{{rendered}}} {number}")
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def maybe_profile(trace):
+    """Sample-profile a fraction of requests with pyinstrument (optional) and keep the profiles of slow ones."""
+    rate = config.get("profiler_sample_rate", 0.0)
+    profiler = None
+    if rate and random.random() < rate:
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            profiler = None
+        else:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            elapsed_ms = (time.perf_counter() - trace.started) * 1000
+            if elapsed_ms >= config.get("profiler_slow_request_ms", 2000):
+                directory = config.get("profiler_output_path", "./profiles/")
+                os.makedirs(directory, exist_ok=True)
+                with open(os.path.join(directory, f"{int(time.time())}_{trace.id}.html"), "w") as f:
+                    f.write(profiler.output_html())
+
+class TraceMiddleware:
+    """ASGI middleware that traces each HTTP request until its last body chunk is sent.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses are timed to the end
+    of the stream instead of to the moment headers go out.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace, token = start_trace(scope["method"], scope["path"])
+        status = 500
+
+        async def traced_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.id.encode("ascii"))]
+            await send(message)
+
+        try:
+            with maybe_profile(trace):
+                await self.app(scope, receive, traced_send)
+        finally:
+            seconds = time.perf_counter() - trace.started
+            # Label by route template (/ingest_jobs/{job_id}) to keep the series count bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            request_seconds.observe(seconds, scope["method"], route, str(status))
+            log_trace(trace, status, seconds, route)
+            end_trace(token)
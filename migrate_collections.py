@@ -0,0 +1,56 @@
+import argparse
+from collections import defaultdict
+from vector_store import get_client, get_collection, get_chat_collection, invalidate_collection
+
+def migrate(source_name, page_size=500, delete_source=False):
+    """Copy every chunk of a shared collection into its chat's partition, keeping ids and embeddings.
+
+    Uses upsert, so an interrupted run can simply be repeated. Returns {chat_id: chunks copied}.
+    """
+    source = get_collection(source_name)
+    copied = defaultdict(int)
+    skipped = 0
+    offset = 0
+    while True:
+        page = source.get(include=["documents", "metadatas", "embeddings"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        offset += len(page["ids"])
+
+        groups = defaultdict(lambda: {"ids": [], "documents": [], "metadatas": [], "embeddings": []})
+        for i, chunk_id in enumerate(page["ids"]):
+            metadata = page["metadatas"][i] or {}
+            if "chat_id" not in metadata:
+                skipped += 1
+                continue
+            group = groups[metadata["chat_id"]]
+            group["ids"].append(chunk_id)
+            group["documents"].append(page["documents"][i])
+            group["metadatas"].append(metadata)
+            group["embeddings"].append(list(page["embeddings"][i]))
+
+        for chat_id, group in groups.items():
+            get_chat_collection(chat_id).upsert(**group)
+            copied[chat_id] += len(group["ids"])
+        print(f"Migrated {offset} chunks...")
+
+    if skipped:
+        print(f"Skipped {skipped} chunks without a chat_id")
+    if delete_source:
+        get_client().delete_collection(source_name)
+        invalidate_collection(source_name)
+    return dict(copied)
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a shared collection into per-chat partitions.")
+    parser.add_argument("--source", default="test", help="shared collection to split")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--delete-source", action="store_true", help="delete the shared collection once copied")
+    args = parser.parse_args()
+
+    copied = migrate(args.source, args.page_size, args.delete_source)
+    for chat_id, count in sorted(copied.items(), key=lambda item: str(item[0])):
+        print(f"chat {chat_id}: {count} chunks")
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,34 @@
 import os
-import pypdfium2
-import yaml
-import chromadb
-from langchain.vectorstores import Chroma
-from langchain.embeddings import SentenceTransformerEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema.document import Document
-from uuid import uuid4
+import shutil
+import tempfile
+import time
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
 from dotenv import load_dotenv
+from embedding_handler import embed_texts
+from vector_store import get_client, get_chat_collection, partition_lock
+from ingest_manifest import load_manifest, save_manifest, ingested_hashes, record_document
+from metrics import observe, record_size, span
+from lifecycle import get_lifecycle_manager
+from config import config
 
 load_dotenv()
 
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 50
+CHUNK_SEPARATORS = ["\n", "\n\n"]
 
 def create_embeddings(embeddings_path=config["embeddings_path"]):
+    from langchain.embeddings import SentenceTransformerEmbeddings
     return SentenceTransformerEmbeddings(model_name=embeddings_path)
 
 def load_vectordb(embeddings):
-    persistent_client = chromadb.PersistentClient("chroma_db")
+    from langchain.vectorstores import Chroma
     langchain_chroma = Chroma(
-        client=persistent_client,
+        client=get_client(),
         collection_name="pdfs",
         embedding_function=embeddings,
     )
@@ -28,41 +36,380 @@ def load_vectordb(embeddings):
 
 def get_pdf_texts(pdfs_bytes_list):
     """Extract text from a list of PDF byte streams."""
-    return [extract_text_from_pdf(pdfs_bytes_list)]
+    return [extract_text_from_pdf(pdf_bytes) for pdf_bytes in pdfs_bytes_list]
+
+def iter_pdf_pages(source, start=0, stop=None):
+    """Yield (page_number, text) for pages [start, stop) of a PDF path or byte string.
+
+    Each page and text page is closed as soon as its text is read, and the document when
+    the generator finishes, so pdfium memory stays at one page.
+    """
+    import pypdfium2
+    pdf = pypdfium2.PdfDocument(source)
+    try:
+        stop = len(pdf) if stop is None else min(stop, len(pdf))
+        for index in range(start, stop):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            try:
+                text = textpage.get_text_range()
+            finally:
+                textpage.close()
+                page.close()
+            yield index + 1, text
+    finally:
+        pdf.close()
+
+def extract_page_range(source, start, stop):
+    """Text of pages [start, stop) as a list of (page_number, text). Runs inside the ingestion process pool."""
+    return list(iter_pdf_pages(source, start, stop))
+
+def count_pages(source):
+    import pypdfium2
+    pdf = pypdfium2.PdfDocument(source)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
 
 def extract_text_from_pdf(pdf_bytes):
     """Extract text from a single PDF byte stream."""
-    pdf_file = pypdfium2.PdfDocument(pdf_bytes)
-    return "\n".join(
-        pdf_file.get_page(page_number).get_textpage().get_text_range()
-        for page_number in range(len(pdf_file))
-    )
+    return "\n".join(text for _, text in iter_pdf_pages(pdf_bytes))
 
 def get_text_chunks(text):
     """Split text into chunks of a specified size."""
-    splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=50, separators=["\n", "\n\n"])
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=CHUNK_SEPARATORS)
     return splitter.split_text(text)
 
+def _page_at(marks, offset):
+    """Page number containing a buffer offset, given ascending (offset, page_number) marks."""
+    page = marks[0][1]
+    for mark_offset, page_number in marks:
+        if mark_offset > offset:
+            break
+        page = page_number
+    return page
+
+def iter_text_chunks(pages):
+    """Split (page_number, text) pages into chunks incrementally.
+
+    Only the unfinished tail of the text is carried from one page to the next, so the
+    splitter's overlap spans page boundaries while memory stays at about one page plus
+    one chunk. Yields {"text", "page_start", "page_end"}.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=CHUNK_SEPARATORS)
+    buffer, marks = "", []
+
+    def located(chunks):
+        position = 0
+        for chunk in chunks:
+            start = buffer.find(chunk, position)
+            start = position if start < 0 else start
+            position = start + 1
+            yield start, {"text": chunk, "page_start": _page_at(marks, start), "page_end": _page_at(marks, start + max(len(chunk), 1) - 1)}
+
+    for page_number, text in pages:
+        if marks:
+            buffer += "\n"
+        marks.append((len(buffer), page_number))
+        buffer += text
+        chunks = splitter.split_text(buffer)
+        if len(chunks) < 2:
+            continue
+        carry_start = 0
+        for position, (start, chunk) in enumerate(located(chunks)):
+            if position == len(chunks) - 1:
+                carry_start = start
+            else:
+                yield chunk
+        # Keep the last, possibly unfinished chunk (and the pages it starts on) for the next page
+        marks = [(max(0, offset - carry_start), page) for offset, page in marks if offset > carry_start or page == _page_at(marks, carry_start)]
+        buffer = buffer[carry_start:]
+    if buffer.strip():
+        for _, chunk in located(splitter.split_text(buffer)):
+            yield chunk
+
 def get_document_chunks(text_list):
-    """Convert a list of text strings into Document chunks."""
-    documents = []
+    """Lazily convert a list of text strings into Document chunks."""
+    from langchain.schema.document import Document
     for text in text_list:
         for chunk in get_text_chunks(text):
-            documents.append(Document(page_content=chunk))
-    return documents
-
-def add_to_db(doc_path, chat_id, collection):
-    metadata = []
-    data = []
-    ids = []
-    with open(doc_path, "rb") as f:
-        pdfs_bytes = f.read()
-    texts = get_pdf_texts(pdfs_bytes)
-    documents = get_document_chunks(texts)
-    for d in documents:
-        metadata.append({"chat_id": chat_id})
-        ids.append(str(uuid4()))
-        data.append(d.page_content)
-    collection.add(documents=data, metadatas=metadata, ids=ids)
-
-# run chroma with command: chroma run --path test --port 9000
\ No newline at end of file
+            yield Document(page_content=chunk)
+
+class IngestCancelled(Exception):
+    """Raised between write batches when an ingestion is cancelled."""
+
+class IngestProgress:
+    """Progress sink for ingestion. The default ignores updates and is never cancelled."""
+
+    def add(self, pages=0, chunks=0):
+        pass
+
+    def check(self):
+        """Raise IngestCancelled if the ingestion should stop."""
+
+def chunking_signature():
+    """Identifies the chunking parameters, so a change to them re-chunks every document."""
+    return f"{CHUNK_SIZE}:{CHUNK_OVERLAP}:{CHUNK_SEPARATORS!r}"
+
+def document_hash(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def file_hash(path, block_size=1 << 20):
+    """document_hash of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_id(chat_id, chunk):
+    """Deterministic id for a chunk: identical text in the same chat and chunking maps to one vector."""
+    key = f"{chat_id}\x00{chunking_signature()}\x00{hashlib.sha256(chunk.encode('utf-8')).hexdigest()}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def open_pdf_source(doc, spill_dir):
+    """Return (name, path) for a PDF given as a path or a (name, bytes) tuple.
+
+    In-memory uploads are written to spill_dir so workers can read page ranges from disk
+    instead of receiving the whole file with every task.
+    """
+    if isinstance(doc, (tuple, list)):
+        name, pdf_bytes = doc
+        fd, path = tempfile.mkstemp(dir=spill_dir, suffix=".pdf")
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+        return name, path
+    return os.path.basename(doc), doc
+
+def write_chunks(collection, documents, metadatas, ids, batch_size=None, progress=None):
+    """Embed and add chunks to the collection in batches of at most batch_size."""
+    batch_size = batch_size or config.get("ingest_batch_size", 256)
+    progress = progress or IngestProgress()
+    for start in range(0, len(documents), batch_size):
+        progress.check()
+        end = start + batch_size
+        embeddings = embed_texts(documents[start:end])
+        with span("chroma_write", chunks=len(documents[start:end])):
+            collection.add(
+                documents=documents[start:end],
+                embeddings=embeddings,
+                metadatas=metadatas[start:end],
+                ids=ids[start:end],
+            )
+        progress.add(chunks=len(documents[start:end]))
+
+def existing_ids(collection, ids, batch_size=None):
+    """Subset of ids already present in the collection."""
+    batch_size = batch_size or config.get("ingest_batch_size", 256)
+    found = set()
+    for start in range(0, len(ids), batch_size):
+        found.update(collection.get(ids=ids[start:start + batch_size], include=[])["ids"])
+    return found
+
+def iter_pages(plans, pool=None, pages_per_task=None, prefetch=None):
+    """Yield (plan_index, page_number, text) for every page of every planned document, in order.
+
+    With a pool, page ranges are extracted by the workers while at most `prefetch` ranges
+    are in flight, so extraction runs ahead of chunking and embedding without ever holding
+    more than a bounded number of pages.
+    """
+    pages_per_task = pages_per_task or config.get("ingest_pages_per_task", 32)
+    if pool is None:
+        for index, plan in enumerate(plans):
+            for page_number, text in iter_pdf_pages(plan["path"]):
+                yield index, page_number, text
+        return
+    tasks = (
+        (index, plan["path"], start, start + pages_per_task)
+        for index, plan in enumerate(plans)
+        for start in range(0, plan["pages"], pages_per_task)
+    )
+    inflight = deque()
+    try:
+        for index, path, start, stop in tasks:
+            inflight.append((index, pool.submit(extract_page_range, path, start, stop)))
+            if len(inflight) >= prefetch:
+                index, future = inflight.popleft()
+                for page_number, text in future.result():
+                    yield index, page_number, text
+        while inflight:
+            index, future = inflight.popleft()
+            for page_number, text in future.result():
+                yield index, page_number, text
+    finally:
+        for _, future in inflight:
+            future.cancel()
+
+def timed(iterator, totals, key):
+    """Pass items through, adding the time spent producing them to totals[key]."""
+    iterator = iter(iterator)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            totals[key] += time.perf_counter() - started
+        yield item
+
+def ingest_document(plan, pages, chat_id, collection, manifest, batch_size=None, progress=None):
+    """Chunk, embed and store one document from its page stream, flushing every batch_size chunks.
+
+    Returns a throughput report. Only chunk ids (not texts) are kept for the whole document,
+    for dedup and the manifest.
+    """
+    batch_size = batch_size or config.get("ingest_batch_size", 256)
+    progress = progress or IngestProgress()
+    totals = {"extract": 0.0, "chunk": 0.0, "write": 0.0}
+    seen, ids, batch = set(), [], []
+    page_count = 0
+
+    def counted(pages):
+        nonlocal page_count
+        for page_number, text in pages:
+            page_count += 1
+            progress.add(pages=1)
+            yield page_number, text
+
+    def flush():
+        started = time.perf_counter()
+        present = existing_ids(collection, [key for key, _ in batch], batch_size)
+        new = [(key, chunk) for key, chunk in batch if key not in present]
+        # chunk_index lets retrieval merge neighbouring chunks back into one passage
+        write_chunks(
+            collection,
+            [chunk["text"] for _, chunk in new],
+            [
+                {"chat_id": chat_id, "source": plan["source"], "chunk_index": chunk["index"], "page_start": chunk["page_start"], "page_end": chunk["page_end"]}
+                for _, chunk in new
+            ],
+            [key for key, _ in new],
+            batch_size,
+            progress,
+        )
+        batch.clear()
+        totals["write"] += time.perf_counter() - started
+        return len(new)
+
+    written = 0
+    chunks = iter_text_chunks(counted(timed(pages, totals, "extract")))
+    for index, chunk in enumerate(timed(chunks, totals, "chunk")):
+        key = chunk_id(chat_id, chunk["text"])
+        if key in seen:
+            continue
+        seen.add(key)
+        ids.append(key)
+        batch.append((key, {**chunk, "index": index}))
+        if len(batch) >= batch_size:
+            written += flush()
+    if batch:
+        written += flush()
+
+    started = time.perf_counter()
+    stale_ids = record_document(manifest, plan["source"], plan["hash"], chunking_signature(), ids)
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+    totals["write"] += time.perf_counter() - started
+
+    # Chunking time as measured includes waiting for pages, which is reported as extraction
+    chunk_seconds = max(0.0, totals["chunk"] - totals["extract"])
+    record_size("pdf", plan["bytes"])
+    observe("pdf_extraction", totals["extract"], pages=page_count)
+    observe("chunking", chunk_seconds)
+    seconds = totals["chunk"] + totals["write"]
+    return {
+        "source": plan["source"],
+        "hash": plan["hash"],
+        "bytes": plan["bytes"],
+        "skipped": False,
+        "pages": page_count,
+        "chunks": written,
+        "extract_seconds": totals["extract"],
+        "chunk_seconds": chunk_seconds,
+        "write_seconds": totals["write"],
+        "pages_per_second": page_count / seconds if seconds else 0.0,
+    }
+
+def skipped_report(plan):
+    return {
+        "source": plan["source"], "hash": plan["hash"], "bytes": plan["bytes"], "skipped": True, "pages": 0, "chunks": 0,
+        "extract_seconds": 0.0, "chunk_seconds": 0.0, "write_seconds": 0.0, "pages_per_second": 0.0,
+    }
+
+def default_ingest_workers():
+    """Extraction processes per ingestion when ingest_workers is 0: the cores split across the ingest job workers."""
+    return max(1, (os.cpu_count() or 1) // max(1, config.get("ingest_job_workers", 2)))
+
+def add_pdfs_to_db(docs, chat_id, collection=None, max_workers=None, batch_size=None, progress=None):
+    """Ingest many PDFs (paths or (name, bytes) tuples) as a stream of pages.
+
+    Pages are extracted (by a process pool when there is enough work for one), split
+    incrementally and written every batch_size chunks, so peak memory depends on the
+    batch size and prefetch window rather than on document size. Chunks go to the chat's
+    own partition unless a collection is given. Documents already in the chat's manifest
+    are skipped, and only chunks not yet in the collection are embedded. Progress is
+    reported to `progress`, whose check() may raise IngestCancelled between batches;
+    documents finished before that stay recorded. Returns one throughput report per
+    document, in input order. Holds the chat's partition_lock throughout.
+    """
+    lock = partition_lock(chat_id)
+    # Ingestions of a chat share its manifest, so they run one at a time; queries go on meanwhile
+    # (shared hold), while eviction and rebuilds wait for the ingestion to finish
+    with lock.ingest, lock.shared():
+        if collection is None:
+            collection = get_chat_collection(chat_id)
+        # A chat being ingested into is in use, whatever its query history
+        lifecycle = get_lifecycle_manager()
+        lifecycle.touch(chat_id)
+        lifecycle.flush()
+        progress = progress or IngestProgress()
+        manifest = load_manifest(chat_id)
+        known_hashes = frozenset(ingested_hashes(manifest, chunking_signature()))
+        reports = {}
+        plans = []
+        spill_dir = tempfile.mkdtemp(prefix="ingest-")
+        pool = None
+        try:
+            for position, doc in enumerate(docs):
+                name, path = open_pdf_source(doc, spill_dir)
+                plan = {"position": position, "source": name, "path": path, "hash": file_hash(path), "bytes": os.path.getsize(path)}
+                if plan["hash"] in known_hashes:
+                    reports[position] = skipped_report(plan)
+                else:
+                    plan["pages"] = count_pages(path)
+                    plans.append(plan)
+
+            total_pages = sum(plan["pages"] for plan in plans)
+            pages_per_task = config.get("ingest_pages_per_task", 32)
+            max_workers = min(max_workers or config.get("ingest_workers") or default_ingest_workers(), -(-total_pages // pages_per_task))
+            if max_workers > 1:
+                # spawn keeps worker processes clear of the threads and models held by the parent
+                pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+            prefetch = config.get("ingest_prefetch_tasks") or 2 * max_workers
+            stream = iter_pages(plans, pool, pages_per_task, prefetch)
+            for index, document_pages in groupby(stream, key=lambda item: item[0]):
+                progress.check()
+                plan = plans[index]
+                reports[plan["position"]] = ingest_document(
+                    plan, ((page_number, text) for _, page_number, text in document_pages), chat_id, collection, manifest, batch_size, progress
+                )
+            # Documents without pages never show up in the stream
+            for plan in plans:
+                if plan["position"] not in reports:
+                    reports[plan["position"]] = ingest_document(plan, iter(()), chat_id, collection, manifest, batch_size, progress)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            shutil.rmtree(spill_dir, ignore_errors=True)
+            if any(not report["skipped"] for report in reports.values()):
+                save_manifest(chat_id, manifest)
+        return [reports[position] for position in sorted(reports)]
+
+def add_to_db(doc_path, chat_id, collection=None, progress=None):
+    return add_pdfs_to_db([doc_path], chat_id, collection, progress=progress)[0]
+
+# run chroma with command: chroma run --path test --port 9000
@@ -1,4 +1,11 @@
 memory_prompt_template = """<s>[INST] You are an AI chatbot having a conversation with a human. Answer his questions.
     Previous conversation: {history}
     Human: {human_input}
-    AI: [/INST]"""
\ No newline at end of file
+    AI: [/INST]"""
+
+memory_summary_prompt_template = """Summarize the conversation below for an assistant that will continue it.
+    Keep names, facts, decisions and open questions; drop greetings and filler. Write at most a few short paragraphs.
+    Summary so far: {summary}
+    New messages:
+    {conversation}
+    Updated summary:"""
@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from embedding_handler import embed_texts
+from lifecycle import get_lifecycle_manager
+from metrics import span
+from vector_store import get_chat_collection, partition_lock
+from config import config
+
+RESULT_FIELDS = ("ids", "documents", "metadatas", "distances", "embeddings")
+
+class RetrievalDispatcher:
+    """Coalesces concurrent retrieval queries into batched embedding and Chroma calls.
+
+    Queries arriving within window_ms of each other are embedded in one forward pass,
+    then issued as one collection.query per (chat, n_results) group; each caller gets
+    back its own row. Identical queries already in flight share a single Future, so
+    async callers should await it through asyncio.shield to avoid cancelling it for others.
+    """
+
+    def __init__(self, window_ms=5, max_batch_size=32, query_workers=4):
+        self.window = max(0, window_ms) / 1000
+        self.max_batch_size = max(1, int(max_batch_size))
+        self._queue = queue.Queue()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.stats = {"queries": 0, "singleflight_hits": 0, "batches": 0, "chroma_queries": 0}
+        self._worker = None
+        self._lock = threading.Lock()
+        # Grouped queries run here so the worker can start collecting the next batch
+        self._query_executor = ThreadPoolExecutor(max_workers=max(1, query_workers), thread_name_prefix="retrieval-query")
+
+    def start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="retrieval-dispatcher", daemon=True)
+                self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker is not None and worker.is_alive():
+            self._queue.put(None)
+            worker.join(timeout)
+        self._query_executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, chat_id, text, n_results=5):
+        """Queue a query and return a Future of {"embedding": vector, "results": one-row Chroma result}.
+
+        The result may be shared with other callers and must not be mutated.
+        """
+        key = (str(chat_id), text, n_results)
+        with self._inflight_lock:
+            self.stats["queries"] += 1
+            future = self._inflight.get(key)
+            if future is not None:
+                self.stats["singleflight_hits"] += 1
+                return future
+            future = self._inflight[key] = Future()
+        future.add_done_callback(lambda _: self._forget(key))
+        self.start()
+        self._queue.put((key, chat_id, future))
+        return future
+
+    def retrieve(self, chat_id, text, n_results=5):
+        return self.submit(chat_id, text, n_results).result()
+
+    def _forget(self, key):
+        with self._inflight_lock:
+            self._inflight.pop(key, None)
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            batch = [(key, chat_id, future) for key, chat_id, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                texts = list(dict.fromkeys(key[1] for key, _, _ in batch))
+                with span("retrieval_embed_batch", queries=len(batch), texts=len(texts)):
+                    vectors = dict(zip(texts, embed_texts(texts)))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            groups = {}
+            self.stats["batches"] += 1
+            for key, chat_id, future in batch:
+                groups.setdefault((key[0], key[2]), (chat_id, []))[1].append((key[1], future))
+            for (_, n_results), (chat_id, members) in groups.items():
+                self.stats["chroma_queries"] += 1
+                self._query_executor.submit(self._query_group, chat_id, n_results, members, vectors)
+
+    def _query_group(self, chat_id, n_results, members, vectors):
+        try:
+            embeddings = [vectors[text] for text, _ in members]
+            # Shared hold: a rebuild or eviction of this chat can't swap the partition out mid-query
+            with partition_lock(chat_id).shared(), span("chroma_query", n_results=n_results, queries=len(members)):
+                results = get_chat_collection(chat_id).query(query_embeddings=embeddings, n_results=n_results)
+        except Exception as e:
+            for _, future in members:
+                future.set_exception(e)
+            return
+        get_lifecycle_manager().touch(chat_id)
+        for row, (text, future) in enumerate(members):
+            future.set_result({
+                "embedding": vectors[text],
+                "results": {field: [results[field][row]] if results.get(field) is not None else None for field in RESULT_FIELDS},
+            })
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_retrieval_dispatcher():
+    """Return the process-wide retrieval dispatcher."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = RetrievalDispatcher(
+                window_ms=config.get("retrieval_batch_window_ms", 5),
+                max_batch_size=config.get("retrieval_max_batch_size", 32),
+                query_workers=config.get("retrieval_query_workers", 4),
+            )
+        return _dispatcher
@@ -0,0 +1,175 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from config import config
+
+class SessionStore:
+    """Append-only chat session store on SQLite.
+
+    Every append is one transaction, so a crash leaves either all or none of a
+    turn's messages. Sessions carry an index row (title, timestamps, message
+    count) so listing them never touches message bodies.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                content TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                through_seq INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+
+    def list_sessions(self, limit=None):
+        """Session index rows, most recently updated first."""
+        query = "SELECT id, title, created_at, updated_at, message_count FROM sessions ORDER BY updated_at DESC"
+        params = ()
+        if limit is not None:
+            query += " LIMIT ?"
+            params = (limit,)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"id": row[0], "title": row[1], "created_at": row[2], "updated_at": row[3], "message_count": row[4]}
+            for row in rows
+        ]
+
+    def get_session(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, title, created_at, updated_at, message_count FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "title": row[1], "created_at": row[2], "updated_at": row[3], "message_count": row[4]}
+
+    def append_messages(self, session_id, messages):
+        """Append message dicts (at least "type" and "content") to a session, creating it if needed.
+
+        Returns the seq assigned to each message.
+        """
+        if not messages:
+            return []
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT message_count FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                first_human = next((m["content"] for m in messages if m.get("type") == "human"), messages[0]["content"])
+                self._conn.execute(
+                    "INSERT INTO sessions (id, title, created_at, updated_at, message_count) VALUES (?, ?, ?, ?, 0)",
+                    (session_id, str(first_human)[:80], now, now),
+                )
+                start = 0
+            else:
+                start = row[0]
+            self._conn.executemany(
+                "INSERT INTO messages (session_id, seq, type, content, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, start + i, message["type"], str(message["content"]), json.dumps(message), now)
+                    for i, message in enumerate(messages)
+                ],
+            )
+            self._conn.execute(
+                "UPDATE sessions SET updated_at = ?, message_count = ? WHERE id = ?",
+                (now, start + len(messages), session_id),
+            )
+        return list(range(start, start + len(messages)))
+
+    def load_messages(self, session_id, limit=None, before_seq=None):
+        """Return up to `limit` most recent messages older than before_seq, in chronological order.
+
+        Each message dict carries its "seq", which is the cursor for loading the previous page.
+        """
+        query = "SELECT seq, data FROM messages WHERE session_id = ?"
+        params = [session_id]
+        if before_seq is not None:
+            query += " AND seq < ?"
+            params.append(before_seq)
+        query += " ORDER BY seq DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [{**json.loads(data), "seq": seq} for seq, data in reversed(rows)]
+
+    def get_summary(self, session_id):
+        """The rolling summary of a session's older messages, or None if it has none yet."""
+        with self._lock:
+            row = self._conn.execute("SELECT summary, through_seq FROM summaries WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        return {"summary": row[0], "through_seq": row[1]}
+
+    def set_summary(self, session_id, summary, through_seq):
+        """Replace the summary, which covers every message up to and including through_seq."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (session_id, summary, through_seq, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, summary, through_seq, time.time()),
+            )
+
+    def delete_session(self, session_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def import_json_sessions(self, directory):
+        """One-off import of legacy whole-file JSON sessions; files already imported are skipped."""
+        imported = 0
+        for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            session_id = os.path.basename(path)
+            if self.get_session(session_id) is not None:
+                continue
+            with open(path, "r") as f:
+                self.append_messages(session_id, json.load(f))
+            imported += 1
+        return imported
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_session_store():
+    """Return the process-wide session store, importing legacy JSON sessions the first time."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore(config.get("session_store_path", "./chat_sessions/sessions.sqlite3"))
+            _store.import_json_sessions(config["chat_history_path"])
+        return _store
@@ -0,0 +1,69 @@
+import math
+import os
+import random
+import sys
+from concurrent.futures import Future
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def embed(text):
+    """Deterministic unit vector per text, so different questions don't look alike to the similarity tier."""
+    rng = random.Random(text)
+    vector = [rng.gauss(0, 1) for _ in range(16)]
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector]
+
+class FakeDispatcher:
+    """Stands in for the retrieval dispatcher: returns the chunks set for each chat."""
+
+    def __init__(self):
+        self.chunks = {}
+
+    def stop(self):
+        pass
+
+    def submit(self, chat_id, text, n_results=5):
+        chunks = self.chunks.get(chat_id, [])
+        future = Future()
+        future.set_result({
+            "embedding": embed(text),
+            "results": {
+                "ids": [[chunk_id for chunk_id, _ in chunks]],
+                "documents": [[text for _, text in chunks]],
+                "metadatas": [[{} for _ in chunks]],
+                "distances": [[0.1 for _ in chunks]],
+            },
+        })
+        return future
+
+class FakeUpstream:
+    """Stands in for the Workers AI client: answers with a counter so reused answers are visible."""
+
+    started = True
+
+    def __init__(self):
+        self.calls = []
+
+    async def aclose(self):
+        pass
+
+    async def run(self, model, payload, lane="interactive"):
+        self.calls.append(payload)
+        return {"response": f"answer {len(self.calls)}"}
+
+@pytest.fixture
+def api(monkeypatch):
+    """fast_api with retrieval and the upstream faked, a fresh answer cache and memory disabled."""
+    from fastapi.testclient import TestClient
+    import answer_cache
+    import fast_api
+
+    dispatcher, upstream = FakeDispatcher(), FakeUpstream()
+    monkeypatch.setattr(fast_api, "get_retrieval_dispatcher", lambda: dispatcher)
+    monkeypatch.setattr(fast_api, "get_client", lambda: upstream)
+    monkeypatch.setattr(fast_api, "get_conversation_memory", lambda: None)
+    monkeypatch.setattr(answer_cache, "_cache", None)
+    client = TestClient(fast_api.app)
+    client.dispatcher, client.upstream = dispatcher, upstream
+    return client
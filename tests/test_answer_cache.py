@@ -0,0 +1,75 @@
+import pytest
+from answer_cache import AnswerCache
+from conversation_memory import ConversationMemory
+from session_store import SessionStore
+
+def ask(api, chat_id, text):
+    response = api.post("/chat_pdf", json={"chat_id": chat_id, "user_id": 1, "input": text})
+    assert response.status_code == 200
+    return response.json()
+
+def test_exact_match_ignores_case_and_trailing_punctuation():
+    cache = AnswerCache()
+    cache.put("Summarize the doc", "model", ["a", "b"], "summary")
+    assert cache.get("summarize the doc?", "model", ["b", "a"]) == "summary"
+    assert cache.get("summarize the doc", "other-model", ["a", "b"]) is None
+    assert cache.get("summarize the doc", "model", ["a"]) is None
+
+def test_empty_retrieval_is_never_cached():
+    cache = AnswerCache()
+    cache.put("summarize the doc", "model", [], "chat 5's answer")
+    assert cache.get("summarize the doc", "model", []) is None
+    assert cache.get_stats()["entries"] == 0
+
+def test_chats_with_empty_retrieval_do_not_share_answers(api):
+    first = ask(api, 5, "summarize the doc")
+    second = ask(api, 6, "Summarize the doc?")
+    assert not first["cached"] and not second["cached"]
+    assert second["response"] != first["response"]
+    assert len(api.upstream.calls) == 2
+
+def test_repeated_question_with_same_chunks_hits(api):
+    api.dispatcher.chunks[5] = [("5-a", "The report covers revenue."), ("5-b", "Costs fell by a tenth.")]
+    first = ask(api, 5, "summarize the doc")
+    second = ask(api, 5, "Summarize the doc?")
+    assert not first["cached"]
+    assert second == {"response": first["response"], "cached": True}
+    assert len(api.upstream.calls) == 1
+
+class WordTokenizer:
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+    def count(self, text):
+        return len(self.encode(text))
+
+@pytest.fixture
+def memory(api, monkeypatch, tmp_path):
+    import fast_api
+    memory = ConversationMemory(SessionStore(str(tmp_path / "memory.sqlite3")), WordTokenizer(), lambda prompt, max_tokens: "summary")
+    monkeypatch.setattr(fast_api, "get_conversation_memory", lambda: memory)
+    yield memory
+    memory.shutdown()
+
+def test_repeated_question_hits_with_memory_enabled(api, memory):
+    api.dispatcher.chunks[5] = [("5-a", "The report covers revenue.")]
+    first = ask(api, 5, "summarize the doc")
+    second = ask(api, 5, "summarize the doc")
+    assert not first["cached"]
+    assert second == {"response": first["response"], "cached": True}
+    assert len(api.upstream.calls) == 1
+
+def test_cached_answer_is_not_reused_after_the_conversation_moves_on(api, memory):
+    api.dispatcher.chunks[5] = [("5-a", "The report covers revenue.")]
+    ask(api, 5, "summarize the doc")
+    ask(api, 5, "what about costs")
+    third = ask(api, 5, "summarize the doc")
+    assert not third["cached"]
+    assert len(api.upstream.calls) == 3
+    # The earlier turns were sent along with the repeated question
+    assert [message["content"] for message in api.upstream.calls[-1]["messages"][1:-1]] == [
+        "summarize the doc", "answer 1", "what about costs", "answer 2",
+    ]
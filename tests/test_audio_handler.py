@@ -0,0 +1,47 @@
+import numpy as np
+import audio_handler
+from audio_handler import SAMPLE_RATE, StreamingTranscriber, iter_audio_windows, join_transcripts
+
+def merged(*texts, overlap_seconds=2):
+    transcriber = StreamingTranscriber(overlap_seconds=overlap_seconds)
+    for text in texts:
+        transcriber.merge(text)
+    return transcriber.transcript
+
+def test_overlapping_words_are_dropped_at_the_seam():
+    assert merged("the quick brown fox jumps over", "jumps over the lazy dog") == "the quick brown fox jumps over the lazy dog"
+
+def test_seam_match_ignores_case_and_punctuation():
+    assert merged("and then we left the room.", "The room, was empty") == "and then we left the room. was empty"
+
+def test_single_repeated_word_is_kept():
+    assert merged("so what I", "I think is fine") == "so what I I think is fine"
+    assert merged("he said the", "the cat sat") == "he said the the cat sat"
+
+def test_match_longer_than_the_overlap_can_hold_is_kept():
+    # One second of overlap holds at most four words
+    text = "one two three four five six"
+    assert merged(text, text + " seven", overlap_seconds=1) == text + " " + text + " seven"
+    assert merged(text, "five six seven", overlap_seconds=1) == "one two three four five six seven"
+
+def test_no_overlap_means_no_dedup():
+    assert merged("we went there", "went there again", overlap_seconds=0) == "we went there went there again"
+
+def test_empty_segments():
+    assert merged("", "hello world", "") == "hello world"
+    assert StreamingTranscriber().preview("") == ""
+
+def test_preview_drops_finalized_words():
+    transcriber = StreamingTranscriber()
+    transcriber.merge("good morning everyone")
+    assert transcriber.preview("morning everyone and welcome") == "and welcome"
+    assert transcriber.transcript == "good morning everyone"
+
+def test_join_transcripts():
+    assert join_transcripts([" first part of it ", "part of it and more", "I", "I agree"]) == "first part of it and more I I agree"
+
+def test_windows_overlap_and_cover_the_tail(monkeypatch):
+    audio = np.arange(25 * SAMPLE_RATE, dtype=np.float32)
+    monkeypatch.setattr(audio_handler, "iter_audio_chunks", lambda audio, chunk_seconds: iter(np.array_split(audio, 7)))
+    windows = list(iter_audio_windows(audio, chunk_seconds=10, overlap_seconds=2))
+    assert [(window[0] / SAMPLE_RATE, len(window) / SAMPLE_RATE) for window in windows] == [(0, 10), (8, 10), (16, 9)]
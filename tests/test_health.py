@@ -0,0 +1,35 @@
+import asyncio
+import pytest
+import audio_handler
+import context_assembler
+import conversation_memory
+import embedding_handler
+import fast_api
+from config import config
+
+@pytest.fixture
+def nothing_loaded(monkeypatch):
+    for module in (audio_handler, embedding_handler):
+        monkeypatch.setattr(module, "_engine", None)
+    monkeypatch.setattr(conversation_memory, "_memory", None)
+    monkeypatch.setattr(context_assembler, "_tokenizer", None)
+    monkeypatch.setattr(fast_api, "prewarm_status", {})
+
+def test_readyz_does_not_create_engines(api, nothing_loaded):
+    response = api.get("/readyz")
+    assert response.status_code == 200
+    assert response.json()["engines"] == {"whisper": False, "embeddings": False, "tokenizer": False, "vector_store": False}
+    assert audio_handler._engine is None
+    assert embedding_handler._engine is None
+
+def test_readyz_waits_for_prewarmed_engines(api, nothing_loaded):
+    fast_api.prewarm_status["embeddings"] = "loading"
+    assert api.get("/readyz").status_code == 503
+
+def test_shutdown_does_not_build_memory_or_tokenizer(api, nothing_loaded, monkeypatch):
+    monkeypatch.setitem(config, "lifecycle_enabled", False)
+    monkeypatch.setattr(conversation_memory, "get_tokenizer", lambda: pytest.fail("shutdown loaded the tokenizer"))
+    asyncio.run(fast_api.shutdown())
+    assert conversation_memory._memory is None
+    assert context_assembler._tokenizer is None
+    assert audio_handler._engine is None
@@ -0,0 +1,172 @@
+import threading
+import pytest
+import vector_store
+from lifecycle import LifecycleManager, LifecycleStore, MaintenanceBusy, rebuild_names
+from vector_store import get_chat_collection, partition_lock
+
+class NotFoundError(Exception):
+    pass
+
+class FakeCollection:
+    """Enough of a Chroma collection for rebuilds; a dropped collection's handle fails like Chroma's."""
+
+    def __init__(self, client, name, metadata):
+        self.client, self.name, self.metadata, self.rows = client, name, metadata, {}
+
+    def _check(self):
+        if self.client.cols.get(self.name) is not self:
+            raise NotFoundError(f"Collection {id(self)} does not exist.")
+
+    def count(self):
+        self._check()
+        return len(self.rows)
+
+    def add(self, ids, documents, metadatas, embeddings):
+        self._check()
+        self.rows.update(zip(ids, zip(documents, metadatas, embeddings)))
+
+    def get(self, include, limit, offset):
+        self._check()
+        ids = sorted(self.rows)[offset:offset + limit]
+        return {
+            "ids": ids,
+            "documents": [self.rows[i][0] for i in ids],
+            "metadatas": [self.rows[i][1] for i in ids],
+            "embeddings": [self.rows[i][2] for i in ids],
+        }
+
+    def query(self, **kwargs):
+        self._check()
+        return {"ids": [sorted(self.rows)[:kwargs.get("n_results", 1)]]}
+
+    def modify(self, name):
+        self._check()
+        self.client.before_rename(self, name)
+        if name in self.client.cols:
+            raise ValueError("UNIQUE constraint failed: collections.name")
+        del self.client.cols[self.name]
+        self.name = name
+        self.client.cols[name] = self
+
+class FakeClient:
+    def __init__(self):
+        self.cols = {}
+        self.before_rename = lambda collection, name: None
+
+    def create_collection(self, name, metadata=None):
+        if name in self.cols:
+            raise ValueError(f"Collection {name} already exists")
+        collection = self.cols[name] = FakeCollection(self, name, metadata)
+        return collection
+
+    def get_or_create_collection(self, name, metadata=None):
+        return self.cols.get(name) or self.create_collection(name, metadata)
+
+    def get_collection(self, name):
+        if name not in self.cols:
+            raise NotFoundError(f"Collection {name} does not exist.")
+        return self.cols[name]
+
+    def delete_collection(self, name):
+        self.get_collection(name)
+        del self.cols[name]
+
+    def list_collections(self):
+        return list(self.cols)
+
+    def counts(self):
+        return {name: len(collection.rows) for name, collection in self.cols.items()}
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(vector_store, "_client", client)
+    monkeypatch.setattr(vector_store, "_collections", {})
+    monkeypatch.setattr(vector_store, "_partition_locks", {})
+    return client
+
+def manager(tmp_path, **kwargs):
+    return LifecycleManager(LifecycleStore(str(tmp_path / "lifecycle.sqlite3")), batch_size=50, batch_pause_s=0, lock_timeout_s=5, **kwargs)
+
+def fill(chat_id, chunks=177):
+    get_chat_collection(chat_id).add(
+        ids=[f"{chat_id}-{i}" for i in range(chunks)], documents=["text"] * chunks, metadatas=[{}] * chunks, embeddings=[[0.1]] * chunks,
+    )
+
+def test_rebuild_keeps_every_chunk_under_concurrent_queries(client, tmp_path):
+    fill(7)
+    lifecycle = manager(tmp_path)
+    stop, errors = threading.Event(), []
+
+    def query():
+        while not stop.is_set():
+            try:
+                with partition_lock(7).shared():
+                    assert get_chat_collection(7).count() == 177
+            except Exception as e:
+                errors.append(e)
+
+    readers = [threading.Thread(target=query) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    for _ in range(5):
+        lifecycle.rebuild(7)
+    stop.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    assert client.counts() == {"chat_7": 177}
+
+def test_swap_failure_restores_the_original(client, tmp_path):
+    fill(7)
+    temp_name, _ = rebuild_names("chat_7")
+
+    def recreate_mid_swap(collection, name):
+        # Another process's request lands between the two renames and recreates the partition empty
+        if collection.name == temp_name and name == "chat_7":
+            client.create_collection("chat_7", {"chat_id": "7"})
+
+    client.before_rename = recreate_mid_swap
+    with pytest.raises(ValueError, match="UNIQUE"):
+        manager(tmp_path).rebuild(7)
+    assert client.counts() == {"chat_7": 177}
+
+def test_interrupted_swap_is_recovered_by_the_next_sweep(client, tmp_path):
+    fill(7)
+    _, backup_name = rebuild_names("chat_7")
+    client.cols["chat_7"].modify(backup_name)
+    vector_store.invalidate_collection("chat_7")
+    assert get_chat_collection(7).count() == 0
+    manager(tmp_path).sweep()
+    assert client.counts() == {"chat_7": 177}
+
+def test_stale_handle_from_another_process_is_refreshed(client, tmp_path):
+    fill(7)
+    handle = get_chat_collection(7)
+    handle.count()
+    stale = vector_store._collections["chat_7"]
+    manager(tmp_path).rebuild(7)
+    # Another process still caches the collection the rebuild replaced
+    vector_store._collections["chat_7"] = stale
+    assert handle.count() == 177
+    assert handle.query(query_embeddings=[[0.1]], n_results=2)["ids"] == [["7-0", "7-1"]]
+    assert vector_store._collections["chat_7"] is client.cols["chat_7"]
+
+def test_only_one_process_maintains_the_store(client, tmp_path):
+    fill(7)
+    first, second = manager(tmp_path), manager(tmp_path)
+    with first.maintenance():
+        assert second.sweep() == []
+        assert second.stats["lease_skips"] == 1
+        with pytest.raises(MaintenanceBusy):
+            second.rebuild(7)
+        # Re-entrant for its holder
+        first.rebuild(7)
+    second.rebuild(7)
+    assert client.counts() == {"chat_7": 177}
+
+def test_expired_lease_can_be_taken_over(client, tmp_path):
+    first, second = manager(tmp_path), manager(tmp_path)
+    assert first.store.acquire_lease("maintenance", "crashed", -1)
+    with second.maintenance():
+        assert not first.store.acquire_lease("maintenance", "other", 60)
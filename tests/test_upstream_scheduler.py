@@ -0,0 +1,88 @@
+import asyncio
+import random
+import pytest
+from upstream_scheduler import AdaptiveLimit, ModelScheduler, UpstreamOverloaded
+
+def test_variable_length_replies_do_not_collapse_the_limit():
+    limit = AdaptiveLimit(initial=8, minimum=1, maximum=32)
+    rng = random.Random(0)
+    now = 0.0
+    for _ in range(2000):
+        latency = rng.uniform(0.5, 20.0)
+        now += latency / 8
+        limit.on_success(latency, now)
+    assert limit.limit == 32
+
+def test_rising_time_to_first_token_shrinks_the_limit():
+    limit = AdaptiveLimit(initial=16, minimum=1, maximum=32, latency_tolerance=2.0)
+    now = 0.0
+    for _ in range(50):
+        now += 1.0
+        limit.on_success(5.0, now, first_token=0.2)
+    healthy = limit.limit
+    for _ in range(50):
+        now += 1.0
+        limit.on_success(5.0, now, first_token=2.0)
+    assert limit.limit < healthy / 2
+
+def test_steady_time_to_first_token_with_variable_replies_grows():
+    limit = AdaptiveLimit(initial=4, minimum=1, maximum=32)
+    rng = random.Random(1)
+    now = 0.0
+    for _ in range(2000):
+        now += 1.0
+        limit.on_success(rng.uniform(0.5, 20.0), now, first_token=rng.uniform(0.2, 0.3))
+    assert limit.limit == 32
+
+def test_failures_halve_once_per_round_trip():
+    limit = AdaptiveLimit(initial=16, minimum=1, maximum=32)
+    limit.on_success(2.0, 0.0)
+    start = limit.limit
+    for offset in (10.0, 10.5, 11.0):
+        limit.on_failure(offset)
+    assert limit.limit == pytest.approx(start / 2)
+    limit.on_failure(12.5)
+    assert limit.limit == pytest.approx(start / 4)
+
+def scheduler(limit=1, max_queue=10, max_queue_wait=5):
+    return ModelScheduler(
+        "model",
+        rate=0,
+        burst=1,
+        limit=AdaptiveLimit(initial=limit, minimum=limit, maximum=limit),
+        max_queue={"interactive": max_queue, "bulk": max_queue},
+        max_queue_wait=max_queue_wait,
+    )
+
+def test_interactive_waiters_are_served_before_bulk():
+    async def main():
+        model = scheduler()
+        await model.acquire("interactive")
+        order = []
+
+        async def call(lane, name):
+            await model.acquire(lane)
+            order.append(name)
+            model.release("ok", 0.1)
+
+        tasks = [asyncio.create_task(call("bulk", "bulk")), asyncio.create_task(call("interactive", "interactive"))]
+        await asyncio.sleep(0.01)
+        model.release("ok", 0.1)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["interactive", "bulk"]
+
+def test_full_lane_is_shed():
+    async def main():
+        model = scheduler(max_queue=1)
+        await model.acquire("bulk")
+        waiting = asyncio.create_task(model.acquire("bulk"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(UpstreamOverloaded):
+            await model.acquire("bulk")
+        model.release("ok", 0.1)
+        await waiting
+        return model.snapshot()
+
+    assert asyncio.run(main())["shed"] == 1
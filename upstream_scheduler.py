@@ -0,0 +1,289 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from metrics import observe
+from config import config
+
+# Lower value wins: interactive chat is served before bulk work such as memory summaries
+LANES = {"interactive": 0, "bulk": 1}
+# Outcomes that mean the upstream is overloaded or failing, as opposed to a bad request or a caller giving up
+FAILURES = ("throttled", "server_errors", "transport_errors")
+
+class UpstreamOverloaded(Exception):
+    """Raised instead of queueing when a model's lane is full or a request waited too long for a slot."""
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Requests-per-second limit with bursts. A rate of 0 disables it."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 when one is available now)."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def pause(self, seconds, now):
+        """Hold every request back for `seconds` (Retry-After) and drop the accumulated burst."""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+class AdaptiveLimit:
+    """Concurrency limit that follows the upstream's behaviour.
+
+    Grows by one per window of successful calls and halves on throttling or server
+    errors. Streamed calls also report their time to first token, which tracks queueing
+    upstream: when its average climbs past latency_tolerance times the best recently
+    seen, the limit shrinks by 10% instead of growing. Whole-call latency is not used for
+    that, because it scales with the length of the reply rather than with load.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=32, latency_tolerance=2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.latency_tolerance = latency_tolerance
+        self.latency = None
+        self.first_token = None
+        self.best_first_token = None
+        self.last_decrease = 0.0
+
+    def _decrease(self, factor, now):
+        # One decrease per round trip, so a burst of failures from the same window counts once
+        if now - self.last_decrease >= (self.latency or 0.0):
+            self.limit = max(self.minimum, self.limit * factor)
+            self.last_decrease = now
+
+    def _increase(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_success(self, latency, now, first_token=None):
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if first_token is None:
+            self._increase()
+            return
+        self.first_token = first_token if self.first_token is None else 0.8 * self.first_token + 0.2 * first_token
+        # Let the baseline drift up slowly so one lucky response doesn't pin it forever
+        self.best_first_token = first_token if self.best_first_token is None else min(first_token, self.best_first_token * 1.01)
+        if self.first_token > self.best_first_token * self.latency_tolerance:
+            self._decrease(0.9, now)
+        else:
+            self._increase()
+
+    def on_failure(self, now):
+        self._decrease(0.5, now)
+
+class Waiter:
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self, loop, future):
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+class ModelScheduler:
+    """Admission control for one upstream model: token bucket, adaptive concurrency and priority lanes.
+
+    Callers from any thread or event loop await acquire() and must call release()
+    with the outcome. Waiters are served strictly by lane, then in arrival order.
+    """
+
+    def __init__(self, model, rate, burst, limit, max_queue, max_queue_wait):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.stats = {
+            "admitted": 0, "ok": 0, "client_errors": 0, "cancelled": 0,
+            "throttled": 0, "server_errors": 0, "transport_errors": 0, "retries": 0, "shed": 0,
+        }
+        self._waiting = {lane: 0 for lane in LANES}
+        self._heap = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def queue_depth(self, lane=None):
+        with self._lock:
+            return self._waiting[lane] if lane else sum(self._waiting.values())
+
+    def _dispatch(self):
+        """Grant slots to waiters while concurrency and tokens allow. Called with the lock held."""
+        while self._heap:
+            lane, _, waiter = self._heap[0]
+            if waiter.future.cancelled() or waiter.granted:
+                heapq.heappop(self._heap)
+                continue
+            if self.in_flight >= int(self.limit.limit):
+                return
+            now = time.monotonic()
+            delay = self.bucket.delay(now)
+            if delay > 0:
+                self._schedule(delay)
+                return
+            heapq.heappop(self._heap)
+            self.bucket.take(now)
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            waiter.granted = True
+            waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+
+    def _schedule(self, delay):
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    async def acquire(self, lane="interactive"):
+        """Wait for a slot. Raises UpstreamOverloaded when the lane is full or the wait exceeds max_queue_wait."""
+        priority = LANES[lane]
+        loop = asyncio.get_running_loop()
+        waiter = Waiter(loop, loop.create_future())
+        with self._lock:
+            if self._waiting[lane] >= self.max_queue[lane]:
+                self.stats["shed"] += 1
+                raise UpstreamOverloaded(f"{self.model}: {lane} queue is full", self._retry_after())
+            self._waiting[lane] += 1
+            heapq.heappush(self._heap, (priority, next(self._order), waiter))
+            self._dispatch()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_queue_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                waiter.future.cancel()
+                if waiter.granted:
+                    # Granted just as we gave up: hand the slot to the next waiter
+                    self.in_flight -= 1
+                    self._dispatch()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.stats["shed"] += 1
+                retry_after = self._retry_after()
+            raise UpstreamOverloaded(f"{self.model}: no upstream slot within {self.max_queue_wait:g}s", retry_after) from None
+        finally:
+            with self._lock:
+                self._waiting[lane] -= 1
+            observe("upstream_queue_wait", time.perf_counter() - started, model=self.model, lane=lane)
+
+    def release(self, outcome, latency=None, retry_after=None, first_token=None):
+        """Give back a slot with the call's outcome (a key of stats); failures shrink the concurrency limit.
+
+        latency is the whole call; first_token is the time to the first token of a streamed call.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            self.stats[outcome] += 1
+            if outcome == "ok":
+                self.limit.on_success(latency, now, first_token)
+            elif outcome in FAILURES:
+                self.limit.on_failure(now)
+            if retry_after:
+                self.bucket.pause(retry_after, now)
+            self._dispatch()
+
+    def record_retry(self):
+        with self._lock:
+            self.stats["retries"] += 1
+
+    def _retry_after(self):
+        # Rough time for the queue ahead to drain at the current rate; called with the lock held
+        depth = sum(self._waiting.values()) + 1
+        rate = self.bucket.rate or self.limit.limit / max(self.limit.latency or 1.0, 1e-3)
+        return max(1.0, round(depth / rate))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "concurrency_limit": self.limit.limit,
+                "queue_depth": dict(self._waiting),
+                "latency_s": self.limit.latency,
+                "first_token_s": self.limit.first_token,
+                **self.stats,
+            }
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
+
+class UpstreamScheduler:
+    """One ModelScheduler per model, configured from upstream_* keys (overridable per model in upstream_model_limits)."""
+
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else config
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _setting(self, model, key, default):
+        overrides = (self.settings.get("upstream_model_limits") or {}).get(model) or {}
+        return overrides.get(key, self.settings.get(f"upstream_{key}", default))
+
+    def model(self, model):
+        with self._lock:
+            scheduler = self._models.get(model)
+            if scheduler is None:
+                setting = lambda key, default: self._setting(model, key, default)
+                scheduler = self._models[model] = ModelScheduler(
+                    model,
+                    rate=setting("rate_per_s", 5.0),
+                    burst=setting("burst", 10),
+                    limit=AdaptiveLimit(
+                        initial=setting("initial_concurrency", 8),
+                        minimum=setting("min_concurrency", 1),
+                        maximum=setting("max_concurrency", 32),
+                        latency_tolerance=setting("latency_tolerance", 2.0),
+                    ),
+                    max_queue={"interactive": setting("max_queue_interactive", 200), "bulk": setting("max_queue_bulk", 1000)},
+                    max_queue_wait=setting("max_queue_wait_s", 30),
+                )
+            return scheduler
+
+    def snapshot(self):
+        with self._lock:
+            models = dict(self._models)
+        return {model: scheduler.snapshot() for model, scheduler in models.items()}
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_upstream_scheduler():
+    """Return the process-wide scheduler shared by the async and blocking Workers AI clients."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = UpstreamScheduler()
+        return _scheduler
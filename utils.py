@@ -10,8 +10,14 @@ def save_chat_history_json(chat_history, file_path):
 def load_chat_history_json(file_path):
     with open(file_path, "r") as f:
         json_data = json.load(f)
-        messages = [HumanMessage(**message) if message["type"] == "human" else AIMessage(**message) for message in json_data]
-        return messages
+        return messages_from_dicts(json_data)
+
+def messages_from_dicts(json_data):
+    messages = []
+    for message in json_data:
+        message = {key: value for key, value in message.items() if key != "seq"}
+        messages.append(HumanMessage(**message) if message["type"] == "human" else AIMessage(**message))
+    return messages
 
 def get_timestamp():
     return datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
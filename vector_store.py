@@ -0,0 +1,192 @@
+import hashlib
+import re
+import threading
+from contextlib import contextmanager
+from config import config
+
+_client = None
+_collections = {}
+_partition_locks = {}
+_lock = threading.Lock()
+
+def create_client():
+    """Build a Chroma client for vector_store_mode: "http" (chroma server) or "persistent" (embedded, no HTTP hop)."""
+    import chromadb
+    mode = config.get("vector_store_mode", "http")
+    if mode == "persistent":
+        return chromadb.PersistentClient(path=config.get("vector_store_path", "./chroma_db"))
+    if mode == "http":
+        return chromadb.HttpClient(
+            host=config.get("vector_store_host", "localhost"),
+            port=config.get("vector_store_port", 9000),
+        )
+    raise ValueError(f"Unknown vector_store_mode: {mode}")
+
+def get_client():
+    """Return the process-wide Chroma client."""
+    global _client
+    with _lock:
+        if _client is None:
+            _client = create_client()
+        return _client
+
+def connected():
+    return _client is not None
+
+def get_collection(name=None, metadata=None):
+    """Return a cached handle to a collection, creating the collection if needed."""
+    name = name or config.get("vector_store_collection", "test")
+    collection = _collections.get(name)
+    if collection is None:
+        client = get_client()
+        with _lock:
+            collection = _collections.get(name)
+            if collection is None:
+                collection = client.get_or_create_collection(name=name, metadata=metadata)
+                _collections[name] = collection
+    return collection
+
+def partition_name(chat_id):
+    """Collection name holding one chat's chunks.
+
+    Chroma names must be 3-63 characters of [A-Za-z0-9._-] starting and ending
+    alphanumeric, so other chat ids fall back to a hash.
+    """
+    prefix = config.get("vector_store_partition_prefix", "chat_")
+    name = f"{prefix}{chat_id}"
+    if len(name) > 63 or not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9_.-]*[A-Za-z0-9]", name) or ".." in name:
+        name = f"{prefix}{hashlib.sha256(str(chat_id).encode('utf-8')).hexdigest()[:32]}"
+    return name
+
+class PartitionLock:
+    """Per-chat lock around a partition.
+
+    Queries and ingestion hold it shared; maintenance that deletes from or replaces the
+    partition (eviction, rebuild, drop) holds it exclusively, so no reader ever sees the
+    collection missing or half-swapped. Shared holders never wait for a queued exclusive
+    one, so live traffic is not stalled behind maintenance; exclusive acquisition takes a
+    timeout instead. `ingest` additionally serializes ingestions of the chat, which
+    read-modify-write its manifest. The exclusive side is re-entrant, and its holder
+    may also take the shared side. Only threads of this process are covered.
+    """
+
+    def __init__(self):
+        self.ingest = threading.Lock()
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+
+    @contextmanager
+    def shared(self):
+        me = threading.get_ident()
+        with self._condition:
+            counted = self._writer != me
+            if counted:
+                self._condition.wait_for(lambda: self._writer is None)
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if counted:
+                with self._condition:
+                    self._readers -= 1
+                    self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self, timeout=None):
+        """Hold the partition alone. Raises TimeoutError if readers don't drain within timeout."""
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                if not self._condition.wait_for(lambda: self._writer is None and self._readers == 0, timeout):
+                    raise TimeoutError("Partition is busy")
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._condition.notify_all()
+
+def partition_lock(chat_id):
+    """Return the process-wide PartitionLock of a chat."""
+    with _lock:
+        lock = _partition_locks.get(str(chat_id))
+        if lock is None:
+            lock = _partition_locks[str(chat_id)] = PartitionLock()
+        return lock
+
+def missing_collection(error):
+    """Whether an error says the collection no longer exists, as a cached handle's does once the
+    collection was dropped or swapped by a rebuild, possibly in another process."""
+    return type(error).__name__ in ("NotFoundError", "InvalidCollectionException") or "does not exist" in str(error)
+
+class CollectionHandle:
+    """Collection looked up by name on each call, so it survives the collection being replaced.
+
+    A rebuild swaps in a copy with a new collection id, which leaves the handles other
+    processes have cached pointing at a collection that no longer exists. A call that
+    fails that way drops the cached handle and is retried once on a fresh one.
+    """
+
+    def __init__(self, name, metadata=None):
+        self.name = name
+        self._metadata = metadata
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(get_collection(self.name, self._metadata), method)(*args, **kwargs)
+        except Exception as e:
+            if not missing_collection(e):
+                raise
+            invalidate_collection(self.name)
+            return getattr(get_collection(self.name, self._metadata), method)(*args, **kwargs)
+
+    @property
+    def metadata(self):
+        return get_collection(self.name, self._metadata).metadata
+
+    def add(self, *args, **kwargs):
+        return self._call("add", *args, **kwargs)
+
+    def upsert(self, *args, **kwargs):
+        return self._call("upsert", *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._call("get", *args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return self._call("query", *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call("delete", *args, **kwargs)
+
+    def count(self):
+        return self._call("count")
+
+def get_chat_collection(chat_id):
+    """Return the partition collection for a chat. The chat id is kept in its metadata for reporting."""
+    return CollectionHandle(partition_name(chat_id), metadata={"chat_id": str(chat_id)})
+
+def invalidate_collection(name=None):
+    """Drop a cached handle, e.g. after the collection was deleted or recreated."""
+    with _lock:
+        _collections.pop(name or config.get("vector_store_collection", "test"), None)
+
+def reset():
+    """Forget the client and every cached collection handle."""
+    global _client
+    with _lock:
+        _client = None
+        _collections.clear()
+
+def health_check():
+    """Check that the store answers. Raises on failure."""
+    return {
+        "mode": config.get("vector_store_mode", "http"),
+        "heartbeat": get_client().heartbeat(),
+    }